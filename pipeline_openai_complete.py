@@ -8,145 +8,638 @@
 """
 
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    # Без pyarrow CSV читается и пишется средствами pandas
+    pa = None
+try:
+    import orjson
+except ImportError:
+    # Без orjson ответы Rainforest разбираются стандартным json
+    orjson = None
 import requests
+from requests.adapters import HTTPAdapter
 import easyocr
+import cv2
+import torch
 from PIL import Image
 import io
 import numpy as np
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Callable, Dict, List, Optional, Tuple, Any
 import argparse
 import sys
 import json
+import csv
 import time
 from datetime import datetime
 import os
 import re
+import threading
+import multiprocessing
+import hashlib
+import functools
+import random
+from pathlib import Path
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import openai
 import base64
 
+# Пакетный OCR: сколько изображений за один вызов readtext_batched и к какому размеру их приводить
+OCR_BATCH_SIZE = 8
+OCR_BATCH_IMAGE_SIZE = (1024, 1024)
+
+# Сколько ждать пакет от процесса-воркера OCR: убитый (OOM) воркер иначе держит Pool вечно
+OCR_JOB_TIMEOUT = 300
+
+# ID изображения в Amazon URL (/images/I/71ABCDEFGHL._AC_SL1500_.jpg)
+AMAZON_IMAGE_ID_RE = re.compile(r'/([A-Z0-9]{10,11})[._-]')
+
+# Размер из суффикса Amazon URL (._SS40_, ._AC_SL1500_, ._SX38_SY50_): миниатюры не OCR-им
+AMAZON_SIZE_TOKEN_RE = re.compile(r'_(?:AC_)?(?:SL|SS|SX|SY|US|UL)(\d+)')
+MIN_OCR_IMAGE_SIDE = 500
+
+# Сколько изображений товара (после ранжирования по URL) вообще отдавать в OCR
+MAX_OCR_CANDIDATES = 4
+
+# Сколько скачанных изображений держать в памяти для повторного использования
+IMAGE_CACHE_SIZE = 64
+
+# Сколько запросов детальных данных держать в работе впереди OCR стадии
+PIPELINE_QUEUE_SIZE = 8
+
+# Максимальная сторона изображения для Vision: больше high detail все равно не использует
+VISION_MAX_SIDE = 1536
+
+# Общий бюджет времени одного вызова Rainforest со всеми повторами, секунд
+RAINFOREST_CALL_DEADLINE = 120
+
+# Вырезанная по OCR панель Supplement Facts: поля вокруг и максимальная сторона для Vision
+CROP_PADDING = 0.1
+CROPPED_MAX_SIDE = 1024
+
+@functools.lru_cache(maxsize=10000)
+def amazon_image_id(url: str) -> str:
+    """ID изображения из Amazon URL или "" (зависит только от URL - результат запоминается)"""
+    match = AMAZON_IMAGE_ID_RE.search(url)
+    return match.group(1) if match else ""
+
+def use_gpu_for_ocr() -> bool:
+    """OCR на GPU, если доступна CUDA. KSP_OCR_DEVICE=cuda|cpu задает устройство явно"""
+    device = os.environ.get('KSP_OCR_DEVICE', '').strip().lower()
+    if device == 'cpu':
+        return False
+    if device == 'cuda' and not torch.cuda.is_available():
+        print("⚠️ KSP_OCR_DEVICE=cuda, но CUDA недоступна - OCR на CPU")
+        return False
+    return torch.cuda.is_available()
+
+def create_ocr_reader(use_gpu: bool) -> easyocr.Reader:
+    """easyocr Reader под устройство + прогрев на пустом кадре (первый вызов модели медленный)"""
+    # На CPU - int8 квантизация моделей easyocr, на GPU - автоподбор алгоритмов cuDNN
+    reader = easyocr.Reader(['en'], gpu=use_gpu, verbose=False,
+                            quantize=not use_gpu, cudnn_benchmark=use_gpu)
+    width, height = OCR_BATCH_IMAGE_SIZE
+    reader.readtext_batched(
+        np.zeros((1, height, width, 3), dtype=np.uint8), n_width=width, n_height=height
+    )
+    return reader
+
+# Reader на процесс: веса CRAFT и распознавателя грузятся не больше одного раза
+# на устройство, сколько бы процессоров (запусков из web_app) ни создавалось
+_OCR_READERS = {}
+_OCR_READERS_LOCK = threading.Lock()
+
+# Reader не потокобезопасен: вызовы общего Reader из нескольких потоков OCR стадии идут по одному
+# (скачивание и подготовка кадров при этом остаются параллельными)
+_OCR_READ_LOCK = threading.Lock()
+
+def get_ocr_reader(use_gpu: bool) -> easyocr.Reader:
+    with _OCR_READERS_LOCK:
+        if use_gpu not in _OCR_READERS:
+            _OCR_READERS[use_gpu] = create_ocr_reader(use_gpu)
+        return _OCR_READERS[use_gpu]
+
+def readtext_frames(reader: easyocr.Reader, frames: np.ndarray) -> List:
+    """readtext_batched по пакету кадров размера OCR_BATCH_IMAGE_SIZE"""
+    width, height = OCR_BATCH_IMAGE_SIZE
+    return reader.readtext_batched(frames, n_width=width, n_height=height, batch_size=len(frames))
+
+# Reader процесса-воркера OCR: создается один раз при старте процесса, а не на каждый пакет
+_worker_ocr_reader = None
+
+def init_ocr_worker(use_gpu: bool):
+    global _worker_ocr_reader
+    _worker_ocr_reader = get_ocr_reader(use_gpu)
+
+def ocr_worker_readtext(frames: np.ndarray) -> List:
+    return readtext_frames(_worker_ocr_reader, frames)
+
+def letterbox(image_np: np.ndarray, size: Tuple[int, int]) -> Tuple[np.ndarray, float]:
+    """
+    Вписывает изображение в size (ширина, высота) без искажения пропорций:
+    уменьшает и дополняет черным справа и снизу. Возвращает (массив, масштаб)
+    """
+    height, width = image_np.shape[:2]
+    scale = min(1.0, size[0] / width, size[1] / height)
+    
+    if scale < 1.0:
+        image_np = cv2.resize(image_np, (max(1, round(width * scale)), max(1, round(height * scale))),
+                              interpolation=cv2.INTER_AREA)
+    
+    canvas = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    canvas[:image_np.shape[0], :image_np.shape[1]] = image_np
+    return canvas, scale
+
+def bounded_map(pool: ThreadPoolExecutor, fn, items, window: int, ordered: bool = True):
+    """
+    Как pool.map, но в работе не больше window задач. Результаты отдаются по порядку,
+    с ordered=False - по мере готовности (одна медленная задача не держит остальные)
+    """
+    items = iter(items)
+    in_flight = deque(pool.submit(fn, item) for item in islice(items, window))
+    
+    while in_flight:
+        if ordered:
+            future = in_flight.popleft()
+        else:
+            future = next(iter(wait(in_flight, return_when=FIRST_COMPLETED).done))
+            in_flight.remove(future)
+        for item in islice(items, 1):
+            in_flight.append(pool.submit(fn, item))
+        yield future.result()
+
+class JsonFileCache:
+    """Кэш на диске: один JSON файл на ключ, запись атомарная (tmp + rename)"""
+    
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', key)}.json"
+    
+    def get(self, key: str, default=None):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+    
+    def __setitem__(self, key: str, value):
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+class CsvAppender:
+    """
+    Дописывает новые записи в конец CSV: промежуточное сохранение стоит O(новых строк),
+    а не перезапись всей таблицы. Заголовок берется из существующего файла или пишется один раз
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.fieldnames = None
+        
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                self.fieldnames = next(csv.reader(f), None)
+    
+    def append(self, df: pd.DataFrame) -> int:
+        if df.empty:
+            return 0
+        
+        write_header = self.fieldnames is None
+        if write_header:
+            self.fieldnames = list(df.columns)
+        
+        # Большой буфер: строки партии уходят на диск несколькими крупными записями
+        with open(self.path, 'a', newline='', encoding='utf-8', buffering=1 << 20) as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames, restval='',
+                                    extrasaction='ignore', lineterminator='\n')
+            if write_header:
+                writer.writeheader()
+            writer.writerows(df.fillna('').to_dict('records'))
+        
+        return len(df)
+
+class AdaptiveLimiter:
+    """
+    AIMD ограничитель параллельных запросов к API: лимит растет на step после успешного
+    ответа и делится пополам на 429/5xx или когда средняя задержка выше latency_target.
+    Retry-After приостанавливает все запросы, а не только повторяемый (не дольше max_pause)
+    """
+    
+    def __init__(self, initial: int = 4, maximum: int = 16, latency_target: float = 10.0, step: float = 0.5,
+                 max_pause: float = 60.0):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.step = step
+        self.max_pause = max_pause
+        self.in_flight = 0
+        self.latencies = deque(maxlen=20)
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+    
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """Ждет свободного места; False - если deadline (time.monotonic) наступил раньше"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    return False
+                
+                pause = self.paused_until - now
+                if pause > 0:
+                    self.condition.wait(pause if remaining is None else min(pause, remaining))
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+    
+    def release(self, latency: Optional[float] = None, overloaded: bool = False,
+                retry_after: Optional[float] = None):
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self.latencies.append(latency)
+            
+            slow = bool(self.latencies) and sum(self.latencies) / len(self.latencies) > self.latency_target
+            if overloaded or slow:
+                self.limit = max(1.0, self.limit / 2)
+                # Следующее решение - по задержкам уже при новом лимите
+                self.latencies.clear()
+            elif latency is not None:
+                self.limit = min(float(self.maximum), self.limit + self.step)
+            
+            if retry_after:
+                # Retry-After: 3600 не должен останавливать весь pipeline на час
+                pause = min(retry_after, self.max_pause)
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.condition.notify_all()
+
+class CircuitOpenError(Exception):
+    """Вызов не выполнен: предохранитель разомкнут, API считается недоступным"""
+    
+    def __init__(self, retry_in: float):
+        super().__init__(f"API недоступен, повтор через {retry_in:.0f}с")
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    Предохранитель: после fail_threshold ошибок подряд размыкается (OPEN) и сразу отклоняет
+    вызовы. Через reset_timeout пропускает одну пробную попытку (HALF-OPEN): успех замыкает
+    его обратно, ошибка - снова размыкает на reset_timeout
+    """
+    
+    def __init__(self, fail_threshold: int = 5, reset_timeout: float = 60.0):
+        self.fail_threshold = fail_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+    
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self.probe_in_flight:
+                raise CircuitOpenError(max(retry_in, 1.0))
+            self.probe_in_flight = True
+    
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+    
+    def record_neutral(self):
+        """Ответ ничего не говорит о доступности API (429, ошибка запроса): счетчик не меняется,
+        но пробный вызов HALF-OPEN освобождается для следующего"""
+        with self.lock:
+            self.probe_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probe_in_flight or self.failures >= self.fail_threshold:
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Retry-After в секундах (формат HTTP-даты не поддерживается - None)"""
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+def rate_limit_nearly_exhausted(headers) -> bool:
+    """Осталось меньше 10% лимита по X-RateLimit-Remaining / X-RateLimit-Limit"""
+    try:
+        return int(headers['X-RateLimit-Remaining']) < 0.1 * int(headers['X-RateLimit-Limit'])
+    except (KeyError, TypeError, ValueError):
+        return False
+
 class OpenAISupplementFactsAI:
     """Класс для AI анализа Supplement Facts изображений через OpenAI Vision API"""
     
-    def __init__(self, api_key: str):
-        self.client = openai.OpenAI(api_key=api_key)
+    # Системный промпт
+    SYSTEM_PROMPT = """Ты эксперт по анализу этикеток пищевых добавок. Извлеки данные из изображения Supplement Facts и верни ТОЛЬКО JSON в следующем формате:
+
+{
+  "ingredients": "список всех ингредиентов через запятую",
+  "dosages": "пары Ингредиент: дозировка через точку с запятой",
+  "age_group": "возрастная группа в формате 2+, 4+ и т.д.",
+  "form": "форма выпуска: Gummies, Chewable, Tablets, Capsules, Liquid, Drops, Powder, Softgels"
+}
+
+Если какое-то поле не найдено, оставь пустую строку. НЕ добавляй никаких комментариев, ТОЛЬКО JSON."""
+    
+    # Structured outputs: модель обязана вернуть JSON ровно с этими полями
+    RESPONSE_FORMAT = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "supplement_facts",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "ingredients": {"type": "string"},
+                    "dosages": {"type": "string"},
+                    "age_group": {"type": "string"},
+                    "form": {
+                        "type": "string",
+                        "enum": ["Gummies", "Chewable", "Tablets", "Capsules",
+                                 "Liquid", "Drops", "Powder", "Softgels", ""]
+                    }
+                },
+                "required": ["ingredients", "dosages", "age_group", "form"],
+                "additionalProperties": False
+            }
+        }
+    }
+    
+    # Финальные статусы задачи Batch API
+    BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+    
+    def __init__(self, api_key: str, max_retries: int = 3, cache_dir: Optional[str] = None,
+                 session: Optional[requests.Session] = None, cropped_detail: str = "low",
+                 model: Optional[str] = None):
+        # SDK сам повторяет 429/5xx/таймауты с экспоненциальной задержкой
+        self.client = openai.OpenAI(api_key=api_key, max_retries=max_retries)
+        # OPENAI_VISION_MODEL=gpt-4o-mini - в разы дешевле, для извлечения полей по схеме обычно хватает
+        self.model = model or os.environ.get('OPENAI_VISION_MODEL', 'gpt-4o')
         self.known_extractions = {
             # Кэш для быстрой обработки известных изображений
         }
+        # Кэш на диске переживает перезапуски pipeline
+        self.cache = JsonFileCache(os.path.join(cache_dir, 'vision')) if cache_dir else None
+        # Рядом - уже пережатые JPEG для Vision
+        self.prepared_dir = Path(cache_dir) / 'vision_images' if cache_dir else None
+        if self.prepared_dir is not None:
+            self.prepared_dir.mkdir(parents=True, exist_ok=True)
+        
+        if session is None:
+            # Свой keep-alive пул, если процессор не передал общую сессию
+            session = requests.Session()
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                'Connection': 'keep-alive',
+                'Accept-Encoding': 'gzip',
+            })
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        # LRU скачанных изображений по ID: OCR и Vision, а также разные товары
+        # с одной и той же картинкой не скачивают ее повторно
+        self.image_cache = OrderedDict()
+        self.image_cache_lock = threading.Lock()
+        self.cropped_detail = cropped_detail
     
     def extract_image_id(self, url: str) -> str:
         """Извлекает ID изображения из Amazon URL"""
-        try:
-            match = re.search(r'/([A-Z0-9]{10,11})[._-]', url)
-            if match:
-                return match.group(1)
-            return ""
-        except:
-            return ""
+        return amazon_image_id(url)
     
     def download_image(self, url: str) -> bytes:
-        """Скачивает изображение по URL"""
-        response = requests.get(url, timeout=30)
+        """Скачивает изображение по URL (с LRU кэшем по ID изображения)"""
+        key = self.extract_image_id(url) or url
+        
+        with self.image_cache_lock:
+            if key in self.image_cache:
+                self.image_cache.move_to_end(key)
+                return self.image_cache[key]
+        
+        response = self.session.get(url, timeout=30)
         response.raise_for_status()
-        return response.content
+        content = response.content
+        
+        with self.image_cache_lock:
+            self.image_cache[key] = content
+            while len(self.image_cache) > IMAGE_CACHE_SIZE:
+                self.image_cache.popitem(last=False)
+        
+        return content
+    
+    def prepare_image(self, image_bytes: bytes, max_side: int = VISION_MAX_SIDE, quality: int = 85,
+                      crop_box: Optional[List[int]] = None) -> bytes:
+        """
+        Уменьшает изображение до max_side и перекодирует в JPEG.
+        Меньше байт - быстрее base64, меньше payload запроса к OpenAI.
+        crop_box - (left, top, right, bottom) области Supplement Facts из OCR стадии:
+        вырезанная панель ужимается до CROPPED_MAX_SIDE.
+        """
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            if crop_box:
+                image = image.crop(tuple(crop_box))
+                max_side = min(max_side, CROPPED_MAX_SIDE)
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            
+            buffer = io.BytesIO()
+            image.convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+            prepared = buffer.getvalue()
+            print(f"         🗜️ Изображение для Vision: {len(image_bytes) // 1024} KB -> {len(prepared) // 1024} KB")
+            return prepared
+        except Exception as e:
+            print(f"         ⚠️ Не удалось пережать изображение, отправляем как есть: {e}")
+            return image_bytes
+    
+    def get_prepared_image(self, url: str, image_bytes: Optional[bytes] = None,
+                           crop_box: Optional[List[int]] = None) -> bytes:
+        """
+        Готовый к отправке JPEG (prepare_image). С cache_dir хранится на диске по ID изображения:
+        повторные попытки и перезапуски не скачивают и не пережимают картинку заново
+        """
+        image_id = self.extract_image_id(url)
+        path = None
+        
+        if self.prepared_dir is not None and image_id:
+            suffix = '_' + '-'.join(str(value) for value in crop_box) if crop_box else ''
+            path = self.prepared_dir / f"{image_id}{suffix}.jpg"
+            if path.exists():
+                return path.read_bytes()
+        
+        if image_bytes is None:
+            image_bytes = self.download_image(url)
+        prepared = self.prepare_image(image_bytes, crop_box=crop_box)
+        
+        if path is not None:
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(prepared)
+            os.replace(tmp_path, path)
+        
+        return prepared
     
     def encode_image_base64(self, image_bytes: bytes) -> str:
         """Кодирует изображение в base64"""
         return base64.b64encode(image_bytes).decode('utf-8')
     
-    def analyze_supplement_facts(self, url: str, product_name: str = "", brand: str = "") -> tuple:
+    def get_cached(self, key: str) -> Optional[tuple]:
+        """Возвращает результат из кэша (память, затем диск) по ID изображения или хэшу"""
+        if not key:
+            return None
+        
+        result = self.known_extractions.get(key)
+        if result is None and self.cache is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                self.known_extractions[key] = result
+        
+        if result is None:
+            return None
+        
+        return (
+            result["ingredients"], 
+            result["dosages"],
+            result.get("age_group", ""),
+            result.get("form", "")
+        )
+    
+    def remember(self, key: str, extraction: tuple):
+        """Сохраняет результат анализа в кэш"""
+        if not key:
+            return
+        
+        ingredients, dosages, age_group, form = extraction
+        result = {
+            "ingredients": ingredients,
+            "dosages": dosages,
+            "age_group": age_group,
+            "form": form
+        }
+        self.known_extractions[key] = result
+        if self.cache is not None:
+            self.cache[key] = result
+    
+    def build_request_body(self, image_base64: str, product_name: str = "", brand: str = "",
+                           detail: str = "high") -> Dict:
+        """
+        Тело запроса chat.completions (общее для обычного и Batch режима).
+        detail="low" - для уже вырезанной панели Supplement Facts: фиксированная цена в токенах
+        """
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system", 
+                    "content": self.SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"Проанализируй Supplement Facts для продукта: {brand} {product_name}"
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{image_base64}",
+                                "detail": detail
+                            }
+                        }
+                    ]
+                }
+            ],
+            "response_format": self.RESPONSE_FORMAT,
+            "max_tokens": 1000,
+            "temperature": 0
+        }
+    
+    def parse_response_content(self, content: str) -> tuple:
+        """Парсит JSON ответ модели (RESPONSE_FORMAT) в (ingredients, dosages, age_group, form)"""
+        data = json.loads(content)
+        
+        return (
+            data.get("ingredients", ""),
+            data.get("dosages", ""),
+            data.get("age_group", ""),
+            data.get("form", "")
+        )
+    
+    def analyze_supplement_facts(self, url: str, product_name: str = "", brand: str = "",
+                                 image_bytes: Optional[bytes] = None,
+                                 crop_box: Optional[List[int]] = None) -> tuple:
         """
         AI анализ изображения с извлечением данных через OpenAI Vision.
+        image_bytes - уже скачанное изображение (например, из OCR стадии), иначе скачивается по url.
+        crop_box - найденная OCR область Supplement Facts, отправляется только она.
         Возвращает: (ingredients, dosages, age_group, form)
         """
         print(f"         🤖 OpenAI Vision анализирует Supplement Facts...")
         
         # Проверяем кэш
         image_id = self.extract_image_id(url)
-        if image_id in self.known_extractions:
+        cached = self.get_cached(image_id)
+        if cached is not None:
             print(f"         ✅ Найден в кэше: {image_id}")
-            result = self.known_extractions[image_id]
-            return (
-                result["ingredients"], 
-                result["dosages"],
-                result.get("age_group", ""),
-                result.get("form", "")
-            )
+            return cached
         
         try:
-            # Скачиваем изображение
-            image_bytes = self.download_image(url)
-            image_base64 = self.encode_image_base64(image_bytes)
+            # Без ID в URL ключом кэша служит хэш содержимого
+            cache_key = image_id
+            if not image_id:
+                if image_bytes is None:
+                    image_bytes = self.download_image(url)
+                cache_key = hashlib.sha256(image_bytes).hexdigest()
+                cached = self.get_cached(cache_key)
+                if cached is not None:
+                    print("         ✅ Найден в кэше по содержимому")
+                    return cached
             
-            # Системный промпт
-            system_prompt = """Ты эксперт по анализу этикеток пищевых добавок. Извлеки данные из изображения Supplement Facts и верни ТОЛЬКО JSON в следующем формате:
-
-{
-  "ingredients": "список всех ингредиентов через запятую",
-  "dosages": "пары Ингредиент: дозировка через точку с запятой",
-  "age_group": "возрастная группа в формате 2+, 4+ и т.д.",
-  "form": "форма выпуска: Gummies, Chewable, Tablets, Capsules, Liquid, Drops, Powder, Softgels"
-}
-
-Если какое-то поле не найдено, оставь пустую строку. НЕ добавляй никаких комментариев, ТОЛЬКО JSON."""
+            image_base64 = self.encode_image_base64(self.get_prepared_image(url, image_bytes, crop_box))
             
-            # Запрос к OpenAI
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"Проанализируй Supplement Facts для продукта: {brand} {product_name}"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_base64}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000,
-                temperature=0
-            )
+            request_body = self.build_request_body(image_base64, product_name, brand, self.detail_for(crop_box))
             
-            # Парсим ответ
-            content = response.choices[0].message.content.strip()
-            
-            # Убираем markdown форматирование
-            if content.startswith("```json"):
-                content = content[7:]
-            if content.endswith("```"):
-                content = content[:-3]
-            content = content.strip()
-            
-            # Парсим JSON
-            data = json.loads(content)
-            
-            ingredients = data.get("ingredients", "")
-            dosages = data.get("dosages", "")
-            age_group = data.get("age_group", "")
-            form = data.get("form", "")
-            
-            # Сохраняем в кэш
-            if image_id:
-                self.known_extractions[image_id] = {
-                    "ingredients": ingredients,
-                    "dosages": dosages,
-                    "age_group": age_group,
-                    "form": form
-                }
+            # Схема ответа задана RESPONSE_FORMAT, невалидный JSON возможен только
+            # при обрыве генерации - повторяем запрос один раз
+            for attempt in range(2):
+                response = self.client.chat.completions.create(**request_body)
+                try:
+                    extraction = self.parse_response_content(response.choices[0].message.content)
+                    break
+                except json.JSONDecodeError as e:
+                    if attempt:
+                        raise
+                    print(f"         ⚠️ Ошибка парсинга JSON, повторяем запрос: {e}")
+            
+            self.remember(cache_key, extraction)
             
             print(f"         ✅ OpenAI анализ завершен")
-            return ingredients, dosages, age_group, form
+            return extraction
             
         except json.JSONDecodeError as e:
             print(f"         ❌ Ошибка парсинга JSON: {e}")
@@ -155,34 +648,230 @@ class OpenAISupplementFactsAI:
         except Exception as e:
             print(f"         ❌ Ошибка OpenAI анализа: {e}")
             return "", "", "", ""
+    
+    def detail_for(self, crop_box: Optional[List[int]]) -> str:
+        """Уровень детализации Vision: вырезанной панели хватает low, полному фото нужен high"""
+        return self.cropped_detail if crop_box else "high"
+    
+    def prepare_batch_jsonl(self, items: List[tuple], batch_file: str) -> int:
+        """
+        Пишет JSONL файл для Batch API.
+        items: [(custom_id, url, product_name, brand, image_bytes, crop_box), ...],
+        image_bytes и crop_box могут быть None
+        Возвращает количество записанных запросов.
+        """
+        written = 0
+        
+        with open(batch_file, 'w', encoding='utf-8') as f:
+            for custom_id, url, product_name, brand, image_bytes, crop_box in items:
+                try:
+                    image_base64 = self.encode_image_base64(self.get_prepared_image(url, image_bytes, crop_box))
+                except Exception as e:
+                    print(f"         ❌ Не удалось скачать {url}: {e}")
+                    continue
+                
+                line = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": self.build_request_body(image_base64, product_name, brand, self.detail_for(crop_box))
+                }
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+                written += 1
+        
+        return written
+    
+    def submit_batch(self, batch_file: str) -> str:
+        """Загружает JSONL и создает задачу Batch API. Возвращает ID задачи"""
+        with open(batch_file, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"   📤 Batch задача создана: {batch.id}")
+        return batch.id
+    
+    def wait_for_batch(self, batch_id: str, poll_interval: int = 30):
+        """Ожидает завершения задачи Batch API"""
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            
+            if batch.status in self.BATCH_FINAL_STATUSES:
+                print(f"   📥 Batch {batch_id}: {batch.status}")
+                return batch
+            
+            counts = batch.request_counts
+            if counts:
+                print(f"   ⏳ Batch {batch_id}: {batch.status} ({counts.completed}/{counts.total})")
+            else:
+                print(f"   ⏳ Batch {batch_id}: {batch.status}")
+            time.sleep(poll_interval)
+    
+    def download_batch_results(self, batch) -> Dict[str, tuple]:
+        """Скачивает результаты Batch API: {custom_id: (ingredients, dosages, age_group, form)}"""
+        results = {}
+        
+        if not batch.output_file_id:
+            return results
+        
+        output = self.client.files.content(batch.output_file_id).text
+        
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            
+            record = json.loads(line)
+            custom_id = record.get("custom_id")
+            response = record.get("response") or {}
+            
+            if record.get("error") or response.get("status_code") != 200:
+                print(f"         ❌ Batch запрос {custom_id} завершился с ошибкой: {record.get('error')}")
+                continue
+            
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[custom_id] = self.parse_response_content(content)
+            except (KeyError, IndexError, json.JSONDecodeError) as e:
+                print(f"         ❌ Ошибка парсинга ответа {custom_id}: {e}")
+        
+        return results
+    
+    def analyze_batch(self, items: List[tuple], poll_interval: int = 30) -> Dict[str, tuple]:
+        """
+        Анализ через OpenAI Batch API (дешевле, без лимитов в минуту, до 24ч).
+        items: [(custom_id, url, product_name, brand, image_bytes, crop_box), ...],
+        image_bytes и crop_box могут быть None
+        Возвращает {custom_id: (ingredients, dosages, age_group, form)}
+        """
+        results = {}
+        to_submit = []
+        
+        for item in items:
+            cached = self.get_cached(self.extract_image_id(item[1]))
+            if cached is not None:
+                results[item[0]] = cached
+            else:
+                to_submit.append(item)
+        
+        if not to_submit:
+            return results
+        
+        batch_file = f"openai_batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+        
+        try:
+            written = self.prepare_batch_jsonl(to_submit, batch_file)
+            print(f"   📝 Batch файл: {batch_file} ({written} запросов)")
+            
+            if not written:
+                return results
+            
+            batch = self.wait_for_batch(self.submit_batch(batch_file), poll_interval)
+            batch_results = self.download_batch_results(batch)
+        finally:
+            if os.path.exists(batch_file):
+                os.remove(batch_file)
+        
+        urls = {item[0]: item[1] for item in to_submit}
+        for custom_id, extraction in batch_results.items():
+            if custom_id in urls:
+                self.remember(self.extract_image_id(urls[custom_id]), extraction)
+        
+        results.update(batch_results)
+        return results
 
 class FullPipelineProcessor:
     """Полный процессор для комплексной обработки витаминов с OpenAI Vision"""
     
-    def __init__(self, rainforest_api_key: str, openai_api_key: str):
+    # Колонки, которые заполняет детальная обработка (Rainforest product + OCR + Vision)
+    DETAIL_COLUMNS = (
+        'Бренд', 'Категория', 'BSR', 'Ссылка на Supplement Facts (изображение)',
+        'Все ингредиенты (из Supplement Facts)', 'Дозировки (мг/ед.)', 'Возрастная группа', 'Форма выпуска'
+    )
+    
+    # Поля search_results, которые попадают в таблицу, и их значения по умолчанию
+    SEARCH_FIELDS = {
+        'asin': '', 'title': '', 'link': '', 'brand': '',
+        'rating': 0, 'ratings_total': 0, 'price': {}, 'bestsellers_rank': []
+    }
+    
+    def __init__(self, rainforest_api_key: str, openai_api_key: str,
+                 detail_concurrency: int = 4, vision_concurrency: int = 8,
+                 vision_mode: str = 'realtime', image_concurrency: int = 16,
+                 cache_dir: Optional[str] = None, ocr_workers: int = 1, easyocr_workers: int = 1):
         self.rainforest_api_key = rainforest_api_key
         self.openai_api_key = openai_api_key
         self.base_url = "https://api.rainforestapi.com/request"
+        self.detail_concurrency = max(1, detail_concurrency)
+        self.vision_concurrency = max(1, vision_concurrency)
+        self.vision_mode = vision_mode
+        self.image_concurrency = max(1, image_concurrency)
+        # Общий пул скачивания изображений на весь запуск, а не новый на каждый товар
+        self.image_pool = ThreadPoolExecutor(max_workers=self.image_concurrency)
+        self.ocr_workers = max(1, ocr_workers)
         
-        print("🔍 Инициализация OCR...")
-        self.ocr_reader = easyocr.Reader(['en'], gpu=False)
-        print("✅ OCR готов")
+        # Кэш OCR вердиктов по ID изображения (Amazon переиспользует картинки между товарами).
+        # С cache_dir вердикты сохраняются на диск и повторный запуск не скачивает картинки
+        self.ocr_verdicts = JsonFileCache(os.path.join(cache_dir, 'ocr')) if cache_dir else {}
+        # Вердикты по хэшу содержимого (blake2b): одна и та же картинка под разными URL/ID
+        # не OCR-ится повторно. С cache_dir - тоже на диске, между запусками
+        self.content_verdicts = JsonFileCache(os.path.join(cache_dir, 'ocr_content')) if cache_dir else {}
         
-        print("🤖 Инициализация OpenAI Vision...")
-        self.ai_analyzer = OpenAISupplementFactsAI(openai_api_key)
-        print("✅ OpenAI Vision готов")
+        use_gpu = use_gpu_for_ocr()
+        self.easyocr_workers = max(1, easyocr_workers)
+        self.ocr_reader = None
+        self.ocr_process_pool = None
+        
+        if self.easyocr_workers > 1:
+            # Reader не потокобезопасен: каждый процесс держит свой (память/VRAM растет с числом процессов)
+            print(f"🔍 Инициализация OCR ({'GPU' if use_gpu else 'CPU'}, процессов: {self.easyocr_workers})...")
+            self.ocr_process_pool = multiprocessing.get_context('spawn').Pool(
+                processes=self.easyocr_workers, initializer=init_ocr_worker, initargs=(use_gpu,)
+            )
+            # Товар дает один пакет (MAX_OCR_CANDIDATES < OCR_BATCH_SIZE): чтобы все процессы
+            # были заняты, потоков OCR стадии нужно не меньше, чем процессов
+            self.ocr_workers = max(self.ocr_workers, self.easyocr_workers)
+        else:
+            print(f"🔍 Инициализация OCR ({'GPU' if use_gpu else 'CPU'})...")
+            self.ocr_reader = get_ocr_reader(use_gpu)
+        print("✅ OCR готов")
         
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Connection': 'keep-alive',
+            'Accept-Encoding': 'gzip',
         })
+        # Keep-alive пул на каждый хост размером со все потоки, которые в него ходят:
+        # со стандартными 10 соединениями лишние потоки открывают новые TLS соединения.
+        # Повторы только на уровне приложения (_rainforest_get), иначе circuit breaker
+        # не видит реальных отказов
+        pool_size = self.detail_concurrency + self.image_concurrency + self.vision_concurrency
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max(64, pool_size), max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         
-        # Ключевые слова для поиска Supplement Facts
-        self.supplement_keywords = [
-            'supplement facts', 'supplement fact', 'nutrition facts',
-            'serving size', 'servings per container', 'amount per serving',
-            'daily value', '% daily value', '%dv'
-        ]
+        print("🤖 Инициализация OpenAI Vision...")
+        self.ai_analyzer = OpenAISupplementFactsAI(openai_api_key, cache_dir=cache_dir, session=self.session)
+        print("✅ OpenAI Vision готов")
+        
+        # Ключевые слова для поиска Supplement Facts и их вес в confidence
+        self.supplement_keywords = {
+            'supplement facts': 0.9, 'supplement fact': 0.8,
+            'serving size': 0.2, 'servings per container': 0.2,
+            'daily value': 0.15, '% daily value': 0.15,
+            'amount per serving': 0.1
+        }
+        
+        # Один скомпилированный паттерн на все ключевые слова: один проход по тексту.
+        # Lookahead дает пересекающиеся совпадения ('% daily value' и 'daily value'),
+        # длинные варианты идут первыми
+        alternatives = sorted(self.supplement_keywords, key=len, reverse=True)
+        self.keyword_pattern = re.compile(
+            '(?=(' + '|'.join(re.escape(keyword) for keyword in alternatives) + '))'
+        )
         
         # Статистика
         self.stats = {
@@ -195,87 +884,179 @@ class FullPipelineProcessor:
             'openai_calls': 0,
             'start_time': datetime.now()
         }
+        self.stats_lock = threading.Lock()
+        
+        # Поисковые запросы, уже попавшие в таблицу (заполняется load_processed_terms)
+        self.processed_terms = set()
+        
+        # Общий AIMD ограничитель для всех запросов к Rainforest (поиск и детальные данные)
+        self.rainforest_limiter = AdaptiveLimiter(initial=self.detail_concurrency)
+        # Если Rainforest лежит, остальные ключи и товары не тратят время на повторы
+        self.rainforest_breaker = CircuitBreaker(fail_threshold=5, reset_timeout=60)
+    
+    def _rainforest_get(self, params: Dict, max_attempts: int = 3) -> Dict:
+        """
+        GET к Rainforest через AIMD ограничитель. Повторяются только временные ошибки -
+        таймауты, обрывы соединения, 429 и 5xx: пауза по Retry-After, иначе экспоненциальная
+        с jitter (повторы потоков не синхронны). Остальные 4xx и битый JSON - сразу ошибка.
+        Все попытки укладываются в RAINFOREST_CALL_DEADLINE.
+        При разомкнутом предохранителе сразу CircuitOpenError
+        """
+        deadline = time.monotonic() + RAINFOREST_CALL_DEADLINE
+        
+        for attempt in range(max_attempts):
+            # Ожидание места в ограничителе (и паузы по Retry-After) тоже входит в дедлайн
+            if not self.rainforest_limiter.acquire(deadline):
+                raise requests.Timeout(f"Rainforest: нет свободного слота за {RAINFOREST_CALL_DEADLINE}с")
+            try:
+                self.rainforest_breaker.before_call()
+            except CircuitOpenError:
+                self.rainforest_limiter.release()
+                raise
+            started = time.monotonic()
+            timeout = max(1.0, min(30.0, deadline - started))
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError):
+                self.rainforest_limiter.release(overloaded=True)
+                self.rainforest_breaker.record_failure()
+                delay = 2 ** attempt * random.uniform(0.5, 1.5)
+                if attempt == max_attempts - 1 or time.monotonic() + delay >= deadline:
+                    raise
+                time.sleep(delay)
+                continue
+            except requests.RequestException:
+                self.rainforest_limiter.release()
+                self.rainforest_breaker.record_neutral()
+                raise
+            
+            overloaded = response.status_code == 429 or response.status_code >= 500
+            retry_after = parse_retry_after(response.headers)
+            # Предохранитель - про "API лежит": 5xx. 429 - обычное ограничение скорости,
+            # его разбирают AIMD ограничитель и Retry-After
+            if response.status_code >= 500:
+                self.rainforest_breaker.record_failure()
+            elif response.status_code == 429:
+                self.rainforest_breaker.record_neutral()
+            else:
+                self.rainforest_breaker.record_success()
+            self.rainforest_limiter.release(
+                time.monotonic() - started,
+                overloaded or rate_limit_nearly_exhausted(response.headers),
+                retry_after if overloaded else None
+            )
+            
+            delay = retry_after if retry_after is not None else 2 ** attempt * random.uniform(0.5, 1.5)
+            if overloaded and attempt < max_attempts - 1 and time.monotonic() + delay < deadline:
+                print(f"      ⏳ Rainforest {response.status_code}, повтор {attempt + 2}/{max_attempts}")
+                time.sleep(delay)
+                continue
+            
+            response.raise_for_status()
+            # orjson разбирает байты ответа напрямую, без промежуточной str
+            return orjson.loads(response.content) if orjson is not None else response.json()
+    
+    def _count(self, key: str, value: int = 1):
+        """Потокобезопасно увеличивает счетчик статистики"""
+        with self.stats_lock:
+            self.stats[key] += value
     
     def load_keywords(self, keywords_file: str) -> List[str]:
         """Загружает ключевые запросы из CSV файла"""
         print(f"📂 Загрузка ключевых запросов из: {keywords_file}")
         
         try:
-            df = pd.read_csv(keywords_file)
-            keywords = df.iloc[:, 1].dropna().tolist()
+            # Маленький файл: модуль csv без pandas. Первая строка - заголовок, ключи во второй колонке
+            with open(keywords_file, newline='', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                keywords = [row[1] for row in reader if len(row) > 1 and row[1].strip()]
             print(f"✅ Загружено {len(keywords)} ключевых запросов")
             return keywords
         except Exception as e:
             print(f"❌ Ошибка загрузки ключевых запросов: {e}")
             return []
     
-    def search_products_multiple_pages(self, search_term: str, max_pages: int = 2) -> List[Dict]:
-        """Поиск товаров с пагинацией"""
+    def search_products_multiple_pages(self, search_term: str, max_pages: int = 2,
+                                       max_pauses: int = 0) -> List[Dict]:
+        """
+        Поиск товаров с пагинацией. При разомкнутом предохранителе Rainforest ждет пробного
+        запроса и продолжает с той же страницы (не больше max_pauses раз), затем CircuitOpenError:
+        уже полученные страницы повторно не запрашиваются и не оплачиваются
+        """
         
         print(f"\n🔍 Поиск товаров: '{search_term}' (до {max_pages} страниц)")
         
         all_products = []
+        pauses = 0
         
         for page in range(1, max_pages + 1):
             print(f"   �� Страница {page}/{max_pages}")
             
-            params = {
-                'api_key': self.rainforest_api_key,
-                'type': 'search',
-                'amazon_domain': 'amazon.com',
-                'search_term': search_term,
-                'page': page
-            }
-            
-            try:
-                response = self.session.get(self.base_url, params=params, timeout=30)
-                response.raise_for_status()
-                
-                data = response.json()
-                
-                self.stats['total_api_calls'] += 1
-                self.stats['search_calls'] += 1
-                
-                if 'request_info' in data:
-                    credits_used = data['request_info'].get('credits_used_this_request', 1)
-                    self.stats['credits_used'] += credits_used
-                    print(f"      💳 Кредитов: {credits_used}")
-                
-                if not data.get('request_info', {}).get('success', False):
-                    print(f"      ❌ Ошибка страницы {page}: {data}")
-                    continue
-                
-                search_results = data.get('search_results', [])
-                print(f"      ✅ Найдено: {len(search_results)} товаров")
-                
-                for result in search_results:
-                    product = {
-                        'asin': result.get('asin', ''),
-                        'title': result.get('title', ''),
-                        'link': result.get('link', ''),
-                        'rating': result.get('rating', 0),
-                        'ratings_total': result.get('ratings_total', 0),
-                        'price': result.get('price', {}),
-                        'image': result.get('image', ''),
-                        'is_prime': result.get('is_prime', False),
-                        'brand': result.get('brand', ''),
-                        'bestsellers_rank': result.get('bestsellers_rank', []),
-                        'search_term': search_term,
-                        'page_found': page
-                    }
-                    all_products.append(product)
-                
-                if page < max_pages:
-                    time.sleep(1)
-                    
-            except Exception as e:
-                print(f"      ❌ Ошибка страницы {page}: {e}")
-                continue
+            while True:
+                try:
+                    all_products.extend(self._search_page(search_term, page))
+                    break
+                except CircuitOpenError as e:
+                    if pauses >= max_pauses:
+                        raise
+                    pauses += 1
+                    print(f"⏸️  Rainforest недоступен, '{search_term}' (страница {page}) ждет {e.retry_in:.0f}с")
+                    time.sleep(e.retry_in)
         
-        self.stats['products_found'] += len(all_products)
+        self._count('products_found', len(all_products))
         print(f"   🎯 Всего найдено товаров: {len(all_products)}")
         return all_products
     
+    def _search_page(self, search_term: str, page: int) -> List[Dict]:
+        """Одна страница поиска: сырые search_results (пусто при ошибке страницы), CircuitOpenError пробрасывается"""
+        params = {
+            'api_key': self.rainforest_api_key,
+            'type': 'search',
+            'amazon_domain': 'amazon.com',
+            'search_term': search_term,
+            'page': page
+        }
+        
+        try:
+            data = self._rainforest_get(params)
+            
+            self._count('total_api_calls')
+            self._count('search_calls')
+            
+            if 'request_info' in data:
+                credits_used = data['request_info'].get('credits_used_this_request', 1)
+                self._count('credits_used', credits_used)
+                print(f"      💳 Кредитов: {credits_used}")
+            
+            if not data.get('request_info', {}).get('success', False):
+                print(f"      ❌ Ошибка страницы {page}: {data}")
+                return []
+            
+            search_results = data.get('search_results', [])
+            print(f"      ✅ Найдено: {len(search_results)} товаров")
+            
+            # Результаты копятся как есть: нужные поля выбираются один раз
+            # при построении таблицы (build_product_records)
+            return search_results
+            
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            print(f"      ❌ Ошибка страницы {page}: {e}")
+            return []
+    
+    def search_keyword(self, search_term: str, max_pages: int = 2, max_pauses: int = 5) -> List[Dict]:
+        """
+        search_products_multiple_pages, переживающий размыкание предохранителя Rainforest:
+        ключ не пропускается, а ждет пробного запроса (не больше max_pauses раз)
+        """
+        try:
+            return self.search_products_multiple_pages(search_term, max_pages, max_pauses)
+        except CircuitOpenError:
+            print(f"❌ Rainforest так и не ответил, '{search_term}' пропущен")
+            return []
+    
     def get_product_details(self, asin: str) -> Dict:
         """Получение детальных данных товара"""
         
@@ -289,17 +1070,14 @@ class FullPipelineProcessor:
         }
         
         try:
-            response = self.session.get(self.base_url, params=params, timeout=30)
-            response.raise_for_status()
+            data = self._rainforest_get(params)
             
-            data = response.json()
-            
-            self.stats['total_api_calls'] += 1
-            self.stats['product_calls'] += 1
+            self._count('total_api_calls')
+            self._count('product_calls')
             
             if 'request_info' in data:
                 credits_used = data['request_info'].get('credits_used_this_request', 1)
-                self.stats['credits_used'] += credits_used
+                self._count('credits_used', credits_used)
                 print(f"      💳 Кредитов: {credits_used}")
             
             if not data.get('request_info', {}).get('success', False):
@@ -317,8 +1095,89 @@ class FullPipelineProcessor:
             print(f"      ❌ Ошибка: {e}")
             return {'success': False, 'error': str(e)}
     
-    def analyze_image_for_supplement_facts(self, image_url: str) -> Dict:
-        """Анализ изображения на Supplement Facts (OCR валидация)"""
+    def normalize_ocr_text(self, ocr_results: List) -> str:
+        """
+        Один буфер текста для поиска ключевых слов: нижний регистр, любые пробелы и
+        переводы строк OCR схлопнуты в один пробел ('Supplement\nFacts' -> 'supplement facts')
+        """
+        return ' '.join(' '.join(item[1] for item in ocr_results).lower().split())
+    
+    def score_supplement_text(self, all_text: str) -> Tuple[float, List[str]]:
+        """Оценивает нормализованный OCR текст на наличие Supplement Facts: (confidence, keywords)"""
+        found = {match.group(1) for match in self.keyword_pattern.finditer(all_text)}
+        
+        # 'supplement fact' учитывается только если нет полного 'supplement facts'
+        if 'supplement facts' in found:
+            found.discard('supplement fact')
+        
+        found_keywords = [keyword for keyword in self.supplement_keywords if keyword in found]
+        confidence = sum((self.supplement_keywords[keyword] for keyword in found_keywords), 0.0)
+        
+        return confidence, found_keywords
+    
+    def apply_ocr_results(self, result: Dict, ocr_results: List, image_size: Tuple[int, int],
+                          scale: Tuple[float, float] = (1.0, 1.0)) -> Dict:
+        """
+        Заполняет результат анализа по выходу easyocr.
+        image_size - (ширина, высота) исходного изображения, scale - множители от координат
+        OCR к исходным (readtext_batched читает изображения, приведенные к одному размеру)
+        """
+        confidence, found_keywords = self.score_supplement_text(self.normalize_ocr_text(ocr_results))
+        
+        result['confidence'] = min(confidence, 1.0)
+        result['keywords_found'] = found_keywords
+        result['contains_supplement_facts'] = confidence > 0.6
+        if result['contains_supplement_facts']:
+            result['crop_box'] = self.find_panel_box(ocr_results, image_size, scale)
+        return result
+    
+    def find_panel_box(self, ocr_results: List, image_size: Tuple[int, int],
+                       scale: Tuple[float, float]) -> Optional[List[int]]:
+        """
+        Область панели Supplement Facts по рамкам OCR: по горизонтали - рамки с ключевыми
+        словами, вниз - до последней строки текста в этих границах. Плюс CROP_PADDING полей.
+        Возвращает [left, top, right, bottom] в координатах исходного изображения или None.
+        """
+        boxes = []
+        for item in ocr_results:
+            bbox = item[0]
+            xs = [point[0] for point in bbox]
+            ys = [point[1] for point in bbox]
+            # Та же нормализация, что и при оценке: рамка 'Supplement\nFacts' - тоже якорь
+            is_anchor = bool(self.keyword_pattern.search(self.normalize_ocr_text([item])))
+            boxes.append((min(xs), min(ys), max(xs), max(ys), is_anchor))
+        
+        anchors = [box for box in boxes if box[4]]
+        if not anchors:
+            return None
+        
+        left = min(box[0] for box in anchors)
+        top = min(box[1] for box in anchors)
+        right = max(box[2] for box in anchors)
+        bottom = max(box[3] for box in anchors)
+        
+        # Строки таблицы ниже заголовка, центр которых попадает в ширину панели
+        for x0, y0, x1, y1, _ in boxes:
+            if y0 >= top and left <= (x0 + x1) / 2 <= right:
+                bottom = max(bottom, y1)
+        
+        pad_x = (right - left) * CROP_PADDING
+        pad_y = (bottom - top) * CROP_PADDING
+        width, height = image_size
+        scale_x, scale_y = scale
+        
+        return [
+            max(0, int((left - pad_x) * scale_x)),
+            max(0, int((top - pad_y) * scale_y)),
+            min(width, int((right + pad_x) * scale_x)),
+            min(height, int((bottom + pad_y) * scale_y))
+        ]
+    
+    def fetch_image_for_ocr(self, image_url: str) -> Tuple[Dict, Optional[np.ndarray]]:
+        """
+        Скачивает изображение и готовит BGR массив для OCR. Массив None - OCR не нужен.
+        Скачанные байты остаются в result['image_bytes'] для Vision стадии
+        """
         result = {
             'url': image_url,
             'accessible': False,
@@ -329,91 +1188,186 @@ class FullPipelineProcessor:
         }
         
         try:
-            response = self.session.get(image_url, timeout=10)
-            response.raise_for_status()
+            content = self.ai_analyzer.download_image(image_url)
             
             result['accessible'] = True
+            result['image_bytes'] = content
+            result['content_hash'] = hashlib.blake2b(content, digest_size=16).hexdigest()
             
-            if len(response.content) < 10000:
-                result['error'] = 'Файл слишком маленький'
-                return result
-            
-            # OCR анализ
-            image = Image.open(io.BytesIO(response.content))
-            image_np = np.array(image)
+            known = self.content_verdicts.get(result['content_hash'])
+            if known is not None:
+                result.update(known)
+                return result, None
             
-            ocr_results = self.ocr_reader.readtext(image_np)
-            all_text = ' '.join([result[1] for result in ocr_results]).lower()
+            if len(content) < 10000:
+                result['error'] = 'Файл слишком маленький'
+                return result, None
             
-            # Поиск ключевых слов
-            found_keywords = []
-            confidence = 0.0
+            # Сразу в BGR массив, который ждет easyocr, без промежуточного PIL изображения
+            image_np = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+            if image_np is None:
+                # Форматы, которые OpenCV не декодирует, - через PIL
+                image_np = np.ascontiguousarray(np.array(Image.open(io.BytesIO(content)).convert('RGB'))[:, :, ::-1])
+            return result, image_np
             
-            if 'supplement facts' in all_text:
-                confidence += 0.9
-                found_keywords.append('supplement facts')
-            elif 'supplement fact' in all_text:
-                confidence += 0.8
-                found_keywords.append('supplement fact')
+        except Exception as e:
+            result['error'] = str(e)
+            return result, None
+    
+    def analyze_image_for_supplement_facts(self, image_url: str) -> Dict:
+        """Анализ изображения на Supplement Facts (OCR валидация)"""
+        return self.ocr_images([image_url])[0]
+    
+    def is_ocr_candidate(self, image_url: str) -> bool:
+        """Дешевый префильтр по URL: миниатюры с Supplement Facts не читаются"""
+        sizes = [int(size) for size in AMAZON_SIZE_TOKEN_RE.findall(image_url)]
+        return not sizes or max(sizes) >= MIN_OCR_IMAGE_SIDE
+    
+    def rank_ocr_candidates(self, images: List[Dict]) -> List[str]:
+        """
+        Порядок изображений для OCR по одним только URL: первые два (главное фото) - в конец,
+        крупные раньше мелких, миниатюры отброшены
+        """
+        ranked = []
+        seen = set()
+        
+        for position, image_data in enumerate(images):
+            image_url = image_data.get('link', '')
+            if not image_url or image_url in seen or not self.is_ocr_candidate(image_url):
+                continue
+            seen.add(image_url)
             
-            additional = [
-                ('serving size', 0.2), ('servings per container', 0.2),
-                ('daily value', 0.15), ('% daily value', 0.15),
-                ('amount per serving', 0.1)
-            ]
+            # Без размера в URL - оригинал, самый крупный вариант
+            sizes = [int(size) for size in AMAZON_SIZE_TOKEN_RE.findall(image_url)]
+            is_hero = position < 2 or image_data.get('variant') == 'MAIN'
+            ranked.append((is_hero, -max(sizes) if sizes else -float('inf'), position, image_url))
+        
+        return [image_url for *_, image_url in sorted(ranked)]
+    
+    def analyze_images_for_supplement_facts(self, image_urls: List[str]) -> List[Dict]:
+        """
+        Пакетный анализ изображений: параллельное скачивание и
+        один вызов easyocr.readtext_batched на каждые OCR_BATCH_SIZE изображений.
+        Вердикты кэшируются по ID изображения - повторные картинки не скачиваются.
+        """
+        results = {}
+        to_fetch = []
+        
+        for image_url in image_urls:
+            image_id = self.ai_analyzer.extract_image_id(image_url)
             
-            for keyword, weight in additional:
-                if keyword in all_text:
-                    confidence += weight
-                    found_keywords.append(keyword)
+            verdict = self.ocr_verdicts.get(image_id) if image_id else None
             
-            result['confidence'] = min(confidence, 1.0)
-            result['keywords_found'] = found_keywords
-            result['contains_supplement_facts'] = confidence > 0.6
+            if verdict is not None:
+                results[image_url] = dict(verdict, url=image_url)
+            elif not self.is_ocr_candidate(image_url):
+                results[image_url] = {
+                    'url': image_url,
+                    'accessible': False,
+                    'contains_supplement_facts': False,
+                    'confidence': 0.0,
+                    'keywords_found': [],
+                    'error': 'Миниатюра, OCR пропущен'
+                }
+            elif image_url not in to_fetch:
+                to_fetch.append(image_url)
+        
+        if to_fetch:
+            print(f"         📥 OCR: {len(to_fetch)} из {len(image_urls)} изображений")
             
-            return result
+            for result in self.ocr_images(to_fetch):
+                results[result['url']] = result
+                
+                if not result['accessible'] or result['error']:
+                    continue
+                
+                # Байты изображения в кэш вердиктов не попадают
+                verdict = {key: value for key, value in result.items() if key not in ('url', 'image_bytes')}
+                self.content_verdicts[result['content_hash']] = verdict
+                
+                image_id = self.ai_analyzer.extract_image_id(result['url'])
+                if image_id:
+                    self.ocr_verdicts[image_id] = verdict
+        
+        return [results[image_url] for image_url in image_urls]
+    
+    def fetch_letterboxed_for_ocr(self, image_url: str) -> Tuple[Dict, Optional[np.ndarray], Tuple[int, int], float]:
+        """fetch_image_for_ocr + letterbox к OCR_BATCH_IMAGE_SIZE: (result, кадр, исходный размер, масштаб)"""
+        result, image_np = self.fetch_image_for_ocr(image_url)
+        if image_np is None:
+            return result, None, (0, 0), 1.0
+        
+        height, width = image_np.shape[:2]
+        frame, scale = letterbox(image_np, OCR_BATCH_IMAGE_SIZE)
+        return result, frame, (width, height), scale
+    
+    def ocr_images(self, image_urls: List[str]) -> List[Dict]:
+        """
+        Скачивает и приводит изображения к одному размеру параллельно (с сохранением
+        пропорций), затем прогоняет их через readtext_batched
+        """
+        fetched = list(self.image_pool.map(self.fetch_letterboxed_for_ocr, image_urls))
+        
+        ready = [item for item in fetched if item[1] is not None]
+        chunks = [ready[start:start + OCR_BATCH_SIZE] for start in range(0, len(ready), OCR_BATCH_SIZE)]
+        batches = [np.stack([frame for _, frame, _, _ in chunk]) for chunk in chunks]
+        
+        if self.ocr_process_pool is not None:
+            # Пакеты расходятся по процессам-воркерам сразу, результаты забираются по порядку
+            jobs = [self.ocr_process_pool.apply_async(ocr_worker_readtext, (frames,)) for frames in batches]
+        
+        for index, chunk in enumerate(chunks):
+            try:
+                if self.ocr_process_pool is not None:
+                    batch_results = jobs[index].get(timeout=OCR_JOB_TIMEOUT)
+                else:
+                    with _OCR_READ_LOCK:
+                        batch_results = readtext_frames(self.ocr_reader, batches[index])
+            except Exception as e:
+                # У TimeoutError пустой текст: пустая ошибка приняла бы сбой за вердикт "панели нет"
+                for result, *_ in chunk:
+                    result['error'] = str(e) or type(e).__name__
+                continue
             
-        except Exception as e:
-            result['error'] = str(e)
-            return result
+            for (result, _, image_size, scale), ocr_results in zip(chunk, batch_results):
+                self.apply_ocr_results(result, ocr_results, image_size, (1 / scale, 1 / scale))
+        
+        return [result for result, *_ in fetched]
     
-    def find_supplement_facts_image(self, product_data: Dict) -> Optional[str]:
-        """Поиск изображения с Supplement Facts"""
+    def find_supplement_facts_image(self, product_data: Dict) -> Optional[Dict]:
+        """
+        Поиск изображения с Supplement Facts.
+        Возвращает результат анализа лучшего изображения ('url', 'confidence', ...,
+        'image_bytes' - уже скачанные байты, если вердикт не из кэша) или None
+        """
         
         images = product_data.get('images', [])
-        if not images:
+        image_urls = self.rank_ocr_candidates(images)[:MAX_OCR_CANDIDATES]
+        if not image_urls:
             return None
             
-        print(f"      🔍 Анализ {len(images)} изображений...")
+        print(f"      🔍 Анализ {len(image_urls)} из {len(images)} изображений...")
         
-        best_image = None
-        best_confidence = 0.0
+        best_analysis = None
         
-        for image_data in images:
-            image_url = image_data.get('link', '')
-            
-            if not image_url:
-                continue
-            
-            analysis = self.analyze_image_for_supplement_facts(image_url)
-            
+        for analysis in self.analyze_images_for_supplement_facts(image_urls):
             if analysis['accessible'] and analysis['contains_supplement_facts']:
                 print(f"         🎉 НАЙДЕН! Уверенность: {analysis['confidence']:.2f}")
                 
-                if analysis['confidence'] > best_confidence:
-                    best_confidence = analysis['confidence']
-                    best_image = image_url
+                if best_analysis is None or analysis['confidence'] > best_analysis['confidence']:
+                    best_analysis = analysis
         
-        if best_image:
-            self.stats['supplement_facts_found'] += 1
-            return best_image
+        if best_analysis:
+            self._count('supplement_facts_found')
+            return best_analysis
         
         return None
     
     def load_existing_data(self, output_file: str) -> pd.DataFrame:
         """Загружает существующие данные или создает пустую таблицу"""
         try:
-            df = pd.read_csv(output_file, dtype=str).fillna("")
+            engine = 'pyarrow' if pa is not None else None
+            df = pd.read_csv(output_file, dtype=str, engine=engine).fillna("")
             print(f"📂 Загружена существующая таблица: {len(df)} записей")
             return df
         except FileNotFoundError:
@@ -423,71 +1377,73 @@ class FullPipelineProcessor:
             print(f"⚠️ Ошибка загрузки {output_file}: {e}")
             return pd.DataFrame()
     
-    def check_search_term_processed(self, df: pd.DataFrame, search_term: str) -> bool:
-        """Проверяет, обработан ли уже данный поисковый запрос"""
-        if df.empty or 'Search Term' not in df.columns:
-            return False
-        
-        existing_records = df[df['Search Term'] == search_term]
-        if len(existing_records) > 0:
-            print(f"🔍 Найдено {len(existing_records)} записей для '{search_term}'")
-            return True
-        return False
+    def load_processed_terms(self, df: pd.DataFrame):
+        """Один раз собирает множество уже обработанных поисковых запросов из таблицы"""
+        if 'Search Term' in df.columns:
+            self.processed_terms = set(df['Search Term'].dropna().unique())
+        else:
+            self.processed_terms = set()
     
-    def create_products_dataframe(self, products: List[Dict], search_term: str, existing_df: pd.DataFrame = None) -> pd.DataFrame:
-        """Создает DataFrame с товарами или дополняет существующий"""
+    def check_search_term_processed(self, search_term: str) -> bool:
+        """Проверяет, обработан ли уже данный поисковый запрос (O(1) по множеству)"""
+        return search_term in self.processed_terms
+    
+    def build_product_records(self, products: List[Dict], search_term: str, start_index: int = 1) -> pd.DataFrame:
+        """Строит записи основной таблицы из результатов поиска (по столбцам, без цикла по товарам)"""
         
         print(f"\n�� Обработка товаров ({len(products)} записей) для '{search_term}'")
         
-        if existing_df is not None and not existing_df.empty:
-            df = existing_df.copy()
-            start_index = len(df) + 1
-        else:
-            df = pd.DataFrame()
-            start_index = 1
-        
-        records = []
-        for i, product in enumerate(products, start_index):
-            price_raw = ""
-            if product['price']:
-                price_raw = product['price'].get('raw', '')
-            
-            bsr_info = ""
-            if product['bestsellers_rank']:
-                bsr_list = []
-                for rank in product['bestsellers_rank']:
-                    category = rank.get('category', 'Unknown')
-                    rank_num = rank.get('rank', 'N/A')
-                    bsr_list.append(f"{category}: #{rank_num}")
-                bsr_info = "; ".join(bsr_list)
-            
-            record = {
-                '№': i,
-                'Search Term': search_term,
-                'ASIN': product['asin'],
-                'Название продукта (Title)': product['title'],
-                'Бренд': product['brand'],
-                'Цена (USD)': price_raw,
-                'Возрастная группа': '',
-                'Форма выпуска': '',
-                'Все ингредиенты (из Supplement Facts)': '',
-                'Дозировки (мг/ед.)': '',
-                'Claims (sugar free, organic и т.д.)': '',
-                'Кол-во отзывов': product['ratings_total'],
-                'Рейтинг': product['rating'],
-                'BSR': bsr_info,
-                'Категория': '',
-                'Ссылка на товар': product['link'],
-                'Ссылка на Supplement Facts (изображение)': ''
-            }
-            records.append(record)
+        if not products:
+            return pd.DataFrame()
         
-        new_df = pd.DataFrame(records)
-        if not df.empty:
-            df = pd.concat([df, new_df], ignore_index=True)
-        else:
-            df = new_df
+        self.processed_terms.add(search_term)
+        # Сырые search_results Rainforest: отсутствующие у части товаров поля -> значения по умолчанию
+        raw = pd.DataFrame(products).reindex(columns=list(self.SEARCH_FIELDS))
+        raw = raw.fillna({field: default for field, default in self.SEARCH_FIELDS.items()
+                          if not isinstance(default, (dict, list))})
+        # Пропуски делают столбец float: количество отзывов возвращаем в целые
+        raw['ratings_total'] = raw['ratings_total'].astype('int64')
+        
+        return pd.DataFrame({
+            '№': np.arange(start_index, start_index + len(raw)),
+            'Search Term': search_term,
+            'ASIN': raw['asin'],
+            'Название продукта (Title)': raw['title'],
+            'Бренд': raw['brand'],
+            'Цена (USD)': raw['price'].map(lambda price: price.get('raw', '') if isinstance(price, dict) else ''),
+            'Возрастная группа': '',
+            'Форма выпуска': '',
+            'Все ингредиенты (из Supplement Facts)': '',
+            'Дозировки (мг/ед.)': '',
+            'Claims (sugar free, organic и т.д.)': '',
+            'Кол-во отзывов': raw['ratings_total'],
+            'Рейтинг': raw['rating'],
+            'BSR': raw['bestsellers_rank'].map(lambda ranks: "; ".join(
+                f"{rank.get('category', 'Unknown')}: #{rank.get('rank', 'N/A')}"
+                for rank in (ranks if isinstance(ranks, list) else [])
+            )),
+            'Категория': '',
+            'Ссылка на товар': raw['link'],
+            'Ссылка на Supplement Facts (изображение)': ''
+        })
+    
+    def merge_records(self, existing_df: pd.DataFrame, frames: List[pd.DataFrame]) -> pd.DataFrame:
+        """Один раз собирает DataFrame из существующей таблицы и накопленных записей"""
+        frames = [frame for frame in [existing_df, *frames] if frame is not None and not frame.empty]
+        
+        if not frames:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        
+        return pd.concat(frames, ignore_index=True)
+    
+    def create_products_dataframe(self, products: List[Dict], search_term: str, existing_df: pd.DataFrame = None) -> pd.DataFrame:
+        """Создает DataFrame с товарами или дополняет существующий"""
+        start_index = len(existing_df) + 1 if existing_df is not None and not existing_df.empty else 1
+        new_df = self.build_product_records(products, search_term, start_index)
         
+        df = self.merge_records(existing_df, [new_df])
         print(f"✅ Таблица обновлена: {len(new_df)} новых записей, всего {len(df)} записей")
         return df
     
@@ -498,47 +1454,242 @@ class FullPipelineProcessor:
         
         return bsr_filled or category_filled
     
-    def process_detailed_products(self, df: pd.DataFrame, limit: int = None) -> pd.DataFrame:
-        """Обрабатывает детальные данные товаров с OpenAI Vision"""
+    def analyze_supplement_image(self, image_url: str, product_title: str, brand: str,
+                                 image_bytes: Optional[bytes] = None,
+                                 crop_box: Optional[List[int]] = None) -> Optional[tuple]:
+        """OpenAI Vision анализ одного изображения. None - если анализ упал"""
+        try:
+            result = self.ai_analyzer.analyze_supplement_facts(
+                image_url, product_title, brand, image_bytes, crop_box
+            )
+            self._count('openai_calls')
+            return result
+        except Exception as e:
+            print(f"      ❌ Ошибка OpenAI анализа: {e}")
+            return None
+    
+    def analyze_supplement_images_batch(self, vision_tasks: List[tuple]) -> List[Optional[tuple]]:
+        """
+        OpenAI Batch API анализ списка задач [(i, image_url, title, brand, image_bytes, crop_box), ...].
+        Результаты возвращаются в порядке задач.
+        """
+        # custom_id - ID изображения: товары с одной и той же картинкой
+        # уходят в Batch одним запросом, результат раздается всем задачам
+        custom_ids = [
+            self.ai_analyzer.extract_image_id(task[1]) or hashlib.sha256(task[1].encode('utf-8')).hexdigest()[:32]
+            for task in vision_tasks
+        ]
+        unique_items = {}
+        for custom_id, (_, *task) in zip(custom_ids, vision_tasks):
+            unique_items.setdefault(custom_id, (custom_id, *task))
+        
+        print(f"\n🤖 OpenAI Batch API: {len(vision_tasks)} изображений, уникальных {len(unique_items)}")
+        
+        batch_results = self.ai_analyzer.analyze_batch(list(unique_items.values()))
+        self._count('openai_calls', len(batch_results))
+        return [batch_results.get(custom_id) for custom_id in custom_ids]
+    
+    def process_detailed_products(self, df: pd.DataFrame, limit: int = None,
+                                  progress_cb: Optional[Callable[[int, int], None]] = None) -> pd.DataFrame:
+        """
+        Обрабатывает детальные данные товаров с OpenAI Vision.
+        progress_cb(готово, всего) вызывается после каждого товара Rainforest/OCR стадий
+        """
         
         total_products = len(df) if limit is None else min(limit, len(df))
         
         print(f"\n🔍 Детальная обработка товаров (лимит: {total_products})")
         
-        processed_count = 0
+        # Позиции колонок для чтения считаем один раз: df.iat[i, j] вместо get_loc на каждую запись
+        ci = {col: df.columns.get_loc(col) for col in ('Название продукта (Title)', 'Бренд')}
+        
+        # Отбираем товары, которые нужно обработать (по numpy массивам колонок, без df.iloc[i])
+        all_asins = df['ASIN'].to_numpy()
+        all_bsr = df['BSR'].to_numpy()
+        all_categories = df['Категория'].to_numpy()
+        
+        processed = [self.is_product_processed({'BSR': all_bsr[i], 'Категория': all_categories[i]})
+                     for i in range(len(df))]
+        # Один ASIN часто находится по нескольким ключам: детальные данные и Vision
+        # запрашиваются один раз на ASIN, остальные строки получают копию
+        enriched_rows = {}
+        for i in range(len(df)):
+            if processed[i]:
+                enriched_rows.setdefault(all_asins[i], i)
+        
+        pending = []
+        first_rows = {}
+        duplicates = {}
+        copied = {}
         skipped_count = 0
+        limit_reached = False
         
         for i in range(len(df)):
-            if limit and processed_count >= limit:
-                print(f"🛑 Достигнут лимит обработки: {limit}")
-                break
-                
-            asin = df.iloc[i]['ASIN']
-            
-            if self.is_product_processed(df.iloc[i]):
-                print(f"⏭️  Товар {i+1}: {asin} - уже обработан")
+            asin = all_asins[i]
+            if processed[i]:
+                if not limit_reached:
+                    print(f"⏭️  Товар {i+1}: {asin} - уже обработан")
                 skipped_count += 1
+            elif asin in enriched_rows:
+                copied[i] = enriched_rows[asin]
+            elif asin in first_rows:
+                duplicates.setdefault(first_rows[asin], []).append(i)
+            elif limit and len(pending) >= limit:
+                if not limit_reached:
+                    print(f"🛑 Достигнут лимит обработки: {limit}")
+                limit_reached = True
+            else:
+                first_rows[asin] = i
+                pending.append(i)
+        
+        duplicate_count = len(copied) + sum(len(rows) for rows in duplicates.values())
+        if duplicate_count:
+            print(f"🔁 Повторяющихся ASIN: {duplicate_count} строк (данные копируются без новых запросов)")
+        
+        asins = [all_asins[i] for i in pending]
+        print(f"\n📡 Товаров к обработке: {len(asins)} "
+              f"(Rainforest потоков: {self.detail_concurrency}, OpenAI потоков: {self.vision_concurrency})")
+        
+        # Конвейер из трех стадий: детальные данные Rainforest подгружаются заранее
+        # (не больше PIPELINE_QUEUE_SIZE в работе), OCR идет в своем пуле потоков
+        # (easyocr/torch отпускает GIL, сетевые стадии не простаивают),
+        # а OpenAI Vision запускается сразу, как только найдено изображение.
+        # Время ~ max(стадий), а не их сумма
+        detail_pool = ThreadPoolExecutor(max_workers=self.detail_concurrency)
+        ocr_pool = ThreadPoolExecutor(max_workers=self.ocr_workers)
+        vision_pool = ThreadPoolExecutor(max_workers=self.vision_concurrency)
+        
+        try:
+            processed_count, updates, vision_tasks, vision_futures, detail_brands = self._run_detail_stages(
+                df, ci, pending, asins, detail_pool, ocr_pool, vision_pool, progress_cb
+            )
+            
+            # OpenAI Vision: в batch режиме все изображения уходят одной задачей
+            if self.vision_mode == 'batch':
+                results = self.analyze_supplement_images_batch(vision_tasks) if vision_tasks else []
+                results = zip([task[0] for task in vision_tasks], results)
+            else:
+                results = [(i, future.result()) for i, future in vision_futures]
+        finally:
+            detail_pool.shutdown(wait=True, cancel_futures=True)
+            ocr_pool.shutdown(wait=True, cancel_futures=True)
+            vision_pool.shutdown(wait=True)
+        
+        for i, result in results:
+            if result is None:
                 continue
             
-            print(f"\n📦 Товар {i+1}: {asin}")
+            ingredients, dosages, age_group, form = result
+            
+            # Заполняем извлеченные данные
+            row = updates[i]
+            row['Все ингредиенты (из Supplement Facts)'] = ingredients
+            row['Дозировки (мг/ед.)'] = dosages
+            
+            if age_group:
+                row['Возрастная группа'] = age_group
             
-            details = self.get_product_details(asin)
+            if form:
+                row['Форма выпуска'] = form
+            
+            print(f"   ✅ Товар {i+1}: возраст '{age_group}', форма '{form}'")
+        
+        # Бренд у дубля свой: бренд из детальных данных ставится, только если у строки он пустой
+        brand_col = ci['Бренд']
+        for i, rows in duplicates.items():
+            if i in updates:
+                for dup in rows:
+                    row = updates[dup] = dict(updates[i])
+                    row.pop('Бренд', None)
+                    own_brand = df.iat[dup, brand_col]
+                    if detail_brands.get(i) and (pd.isna(own_brand) or not str(own_brand).strip()):
+                        row['Бренд'] = detail_brands[i]
+        
+        # Позиции колонок - один раз; пустые значения (в т.ч. 'Бренд') не затирают данные строки-дубля
+        detail_ci = {col: df.columns.get_loc(col) for col in self.DETAIL_COLUMNS if col in df.columns}
+        for dup, i in copied.items():
+            row = updates[dup] = {}
+            for col, j in detail_ci.items():
+                value = df.iat[i, j]
+                if pd.notna(value) and str(value).strip():
+                    row[col] = value
+        
+        self.apply_row_updates(df, updates)
+        
+        print(f"\n📊 Обработка завершена: {processed_count} обработано, {skipped_count} пропущено")
+        return df
+    
+    def apply_row_updates(self, df: pd.DataFrame, updates: Dict[int, Dict[str, Any]]):
+        """Записывает накопленные обновления {строка: {колонка: значение}}: одно присваивание на колонку"""
+        columns = {}
+        for i, row in updates.items():
+            for col, value in row.items():
+                rows, values = columns.setdefault(col, ([], []))
+                rows.append(i)
+                values.append(value)
+        
+        for col, (rows, values) in columns.items():
+            df.iloc[rows, df.columns.get_loc(col)] = values
+    
+    def _detail_stage(self, item: Tuple[int, str]) -> Tuple[int, str, Dict]:
+        """Стадия Rainforest: (i, asin) -> (i, asin, details)"""
+        i, asin = item
+        return i, asin, self.get_product_details(asin)
+    
+    def _ocr_stage(self, item: Tuple[int, str, Dict]) -> Tuple[int, str, Dict, Optional[Dict]]:
+        """OCR стадия конвейера: (i, asin, details) -> (i, asin, details, supplement_analysis)"""
+        i, asin, details = item
+        print(f"\n📦 Товар {i+1}: {asin}")
+        
+        if not details['success']:
+            return i, asin, details, None
+        
+        return i, asin, details, self.find_supplement_facts_image(details['product'])
+    
+    def _run_detail_stages(self, df: pd.DataFrame, ci: Dict[str, int], pending: List[int], asins: List[str],
+                           detail_pool: ThreadPoolExecutor, ocr_pool: ThreadPoolExecutor,
+                           vision_pool: ThreadPoolExecutor,
+                           progress_cb: Optional[Callable[[int, int], None]] = None
+                           ) -> Tuple[int, Dict[int, Dict[str, Any]], List[tuple], List[tuple], Dict[int, str]]:
+        """
+        Стадии Rainforest -> OCR -> запуск Vision. df только читается, изменения копятся в updates.
+        Возвращает (число обработанных, обновления строк, задачи Vision в batch режиме,
+        (строка, future) Vision в realtime режиме, бренд из детальных данных по строке)
+        """
+        processed_count = 0
+        updates = {}
+        detail_brands = {}
+        vision_tasks = []
+        vision_futures = []
+        # Стадии отдают товары по мере готовности: запись идет по индексу строки,
+        # поэтому медленный ответ Rainforest не задерживает OCR остальных товаров
+        all_details = bounded_map(detail_pool, self._detail_stage, zip(pending, asins),
+                                  PIPELINE_QUEUE_SIZE, ordered=False)
+        ocr_results = bounded_map(ocr_pool, self._ocr_stage, all_details, self.ocr_workers, ordered=False)
+        
+        for done, (i, asin, details, supplement_analysis) in enumerate(ocr_results, 1):
+            if progress_cb:
+                progress_cb(done, len(pending))
             
             if not details['success']:
                 print(f"      ❌ Ошибка получения данных: {details.get('error', 'Unknown')}")
                 continue
             
             product_data = details['product']
+            row = updates[i] = {}
+            brand = df.iat[i, ci['Бренд']]
             
             # Обновляем основные данные
-            if not df.iloc[i]['Бренд'] and product_data.get('brand'):
-                df.iloc[i, df.columns.get_loc('Бренд')] = product_data['brand']
+            if product_data.get('brand'):
+                detail_brands[i] = product_data['brand']
+            if not brand and product_data.get('brand'):
+                brand = row['Бренд'] = product_data['brand']
             
             # Обновляем категорию
             categories = product_data.get('categories', [])
             if categories:
                 category_names = [cat.get('name', '') for cat in categories]
-                df.iloc[i, df.columns.get_loc('Категория')] = ' > '.join(category_names)
+                row['Категория'] = ' > '.join(category_names)
             
             # Обновляем BSR из детальных данных
             bestsellers_rank = product_data.get('bestsellers_rank', [])
@@ -547,59 +1698,61 @@ class FullPipelineProcessor:
                 bsr_number = first_rank.get('rank', 'N/A')
                 bsr_category = first_rank.get('category', 'Unknown')
                 
-                df.iloc[i, df.columns.get_loc('BSR')] = str(bsr_number)
+                row['BSR'] = str(bsr_number)
                 print(f"      📊 BSR: #{bsr_number} ({bsr_category})")
             
-            # Ищем Supplement Facts
-            supplement_image = self.find_supplement_facts_image(product_data)
-            
-            if supplement_image:
-                df.iloc[i, df.columns.get_loc('Ссылка на Supplement Facts (изображение)')] = supplement_image
+            # Supplement Facts уже найден OCR стадией
+            if supplement_analysis:
+                supplement_image = supplement_analysis['url']
+                row['Ссылка на Supplement Facts (изображение)'] = supplement_image
                 print(f"      🎯 Supplement Facts найден!")
-                
-                # OpenAI Vision анализ
-                try:
-                    product_title = df.iloc[i]['Название продукта (Title)']
-                    brand = df.iloc[i]['Бренд']
-                    
-                    ingredients, dosages, age_group, form = self.ai_analyzer.analyze_supplement_facts(
-                        supplement_image, product_title, brand
-                    )
-                    
-                    self.stats['openai_calls'] += 1
-                    
-                    # Заполняем извлеченные данные
-                    df.iloc[i, df.columns.get_loc('Все ингредиенты (из Supplement Facts)')] = ingredients
-                    df.iloc[i, df.columns.get_loc('Дозировки (мг/ед.)')] = dosages
-                    
-                    if age_group:
-                        df.iloc[i, df.columns.get_loc('Возрастная группа')] = age_group
-                        print(f"         📅 Возраст: {age_group}")
-                    
-                    if form:
-                        df.iloc[i, df.columns.get_loc('Форма выпуска')] = form
-                        print(f"         💊 Форма: {form}")
-                    
-                    print(f"      ✅ OpenAI Vision анализ завершен!")
-                    
-                except Exception as e:
-                    print(f"      ❌ Ошибка OpenAI анализа: {e}")
-                
+                # Байты и область панели из OCR стадии идут в Vision без повторного скачивания
+                task = (
+                    i, supplement_image,
+                    df.iat[i, ci['Название продукта (Title)']], brand,
+                    supplement_analysis.get('image_bytes'), supplement_analysis.get('crop_box')
+                )
+                # Байты изображения держим только для Batch API: в realtime режиме они уже
+                # переданы в future и не должны жить до конца обработки всех товаров
+                if self.vision_mode == 'batch':
+                    vision_tasks.append(task)
+                else:
+                    vision_futures.append((i, vision_pool.submit(self.analyze_supplement_image, *task[1:])))
             else:
                 print(f"      ❌ Supplement Facts не найден")
             
             processed_count += 1
-            time.sleep(1)
         
-        print(f"\n📊 Обработка завершена: {processed_count} обработано, {skipped_count} пропущено")
-        return df
+        return processed_count, updates, vision_tasks, vision_futures, detail_brands
     
     def save_results(self, df: pd.DataFrame, output_file: str):
-        """Сохраняет результаты в CSV"""
+        """Сохраняет результаты в CSV: запись во временный файл и атомарная замена"""
         print(f"\n💾 Сохранение результатов в: {output_file}")
-        df.to_csv(output_file, index=False, encoding='utf-8')
+        # Падение посреди записи не оставляет обрезанный файл: читатели (и /download)
+        # видят либо старую, либо новую версию целиком
+        tmp_file = f"{output_file}.tmp"
+        if pa is None:
+            df.to_csv(tmp_file, index=False, encoding='utf-8')
+        else:
+            try:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Смешанные типы в столбце (строки из CSV и числа из API) - пишем все строками
+                table = pa.Table.from_pandas(df.fillna('').astype(str), preserve_index=False)
+            # Батчи по 8192 строк вместо 1024 по умолчанию: меньше переходов Python <-> C++
+            pa_csv.write_csv(table, tmp_file, write_options=pa_csv.WriteOptions(batch_size=8192))
+        os.replace(tmp_file, output_file)
         print(f"✅ Сохранено {len(df)} записей")
     
+    def close(self):
+        """Останавливает пулы скачивания и OCR процессов"""
+        self.image_pool.shutdown(wait=False)
+        if self.ocr_process_pool is not None:
+            # Все результаты к этому моменту уже забраны. close() + join() ждал бы и пакеты,
+            # брошенные по OCR_JOB_TIMEOUT (убитый воркер), - вечно; terminate() их не ждет
+            self.ocr_process_pool.terminate()
+            self.ocr_process_pool.join()
+    
     def print_stats(self):
         """Выводит финальную статистику"""
         duration = datetime.now() - self.stats['start_time']
@@ -616,89 +1769,186 @@ class FullPipelineProcessor:
         print(f"🎯 Найдено Supplement Facts: {self.stats['supplement_facts_found']}")
         print("=" * 60)
 
-def main():
-    parser = argparse.ArgumentParser(description='Полный pipeline с OpenAI Vision API')
-    parser.add_argument('--rainforest-key', help='Rainforest API ключ (или используется RAINFOREST_API_KEY из env)')
-    parser.add_argument('--openai-key', help='OpenAI API ключ (или используется OPENAI_API_KEY из env)')
-    parser.add_argument('--keywords-file', default='Kids Supplements Keywords.csv', help='Файл с ключевыми запросами')
-    parser.add_argument('--output-file', default='kids_supplements.csv', help='Выходной файл')
-    parser.add_argument('--max-pages', type=int, default=2, help='Максимум страниц поиска')
-    parser.add_argument('--detail-limit', type=int, default=3, help='Количество товаров для детальной обработки')
+def main_as_lib(rainforest_key: str, openai_key: str, keyword_limit: int = 1, detail_limit: int = 3,
+                progress_cb: Optional[Callable[[int, str], None]] = None,
+                keywords_file: str = 'Kids Supplements Keywords.csv', output_file: str = 'kids_supplements.csv',
+                max_pages: int = 2, search_concurrency: int = 4, rainforest_concurrency: int = 4,
+                openai_concurrency: int = 8, mode: str = 'realtime', ocr_workers: int = 1,
+                easyocr_workers: int = 1, cache_dir: Optional[str] = '.supplement_cache') -> bool:
+    """
+    Полный pipeline для вызова из кода (веб-интерфейс запускает его в своем потоке).
+    progress_cb(процент, сообщение) получает реальный прогресс стадий.
+    Возвращает True, если результаты сохранены; ошибки пробрасываются вызывающему.
+    Лимиты обязательны: "все ключи/товары" - только явный 0 (как в CLI), None - ошибка
+    """
+    if keyword_limit is None or detail_limit is None:
+        raise ValueError("keyword_limit и detail_limit обязательны (0 - без ограничения)")
     
-    args = parser.parse_args()
-    
-    # Получаем API ключи из аргументов или environment variables
-    rainforest_key = args.rainforest_key or os.environ.get('RAINFOREST_API_KEY')
-    openai_key = args.openai_key or os.environ.get('OPENAI_API_KEY')
-    
-    if not rainforest_key:
-        print("❌ Ошибка: Rainforest API ключ не найден")
-        print("💡 Укажите --rainforest-key или установите RAINFOREST_API_KEY")
-        return
-    
-    if not openai_key:
-        print("❌ Ошибка: OpenAI API ключ не найден")
-        print("💡 Укажите --openai-key или установите OPENAI_API_KEY")
-        return
+    def report(pct: int, message: str):
+        if progress_cb:
+            progress_cb(pct, message)
     
     print("🚀 ЗАПУСК ПОЛНОГО PIPELINE С OPENAI VISION")
     print("=" * 60)
+    report(5, 'Инициализация моделей...')
     
-    processor = FullPipelineProcessor(rainforest_key, openai_key)
+    processor = FullPipelineProcessor(
+        rainforest_key, openai_key,
+        detail_concurrency=rainforest_concurrency,
+        vision_concurrency=openai_concurrency,
+        vision_mode=mode,
+        cache_dir=cache_dir or None,
+        ocr_workers=ocr_workers,
+        easyocr_workers=easyocr_workers
+    )
     
     try:
         # Загружаем ключевые запросы
-        keywords = processor.load_keywords(args.keywords_file)
+        keywords = processor.load_keywords(keywords_file)
         if not keywords:
             print("❌ Ключевые запросы не загружены")
-            return
+            return False
         
         # Загружаем существующие данные
         existing_df = processor.load_existing_data('kids_supplements.csv')
+        processor.load_processed_terms(existing_df)
+        
+        # Обрабатываем ключевые запросы: таблицы новых записей копятся в списке,
+        # общий DataFrame собирается один раз после цикла
+        new_frames = []
+        new_rows = 0
+        # Промежуточные сохранения дописывают только новые строки
+        checkpoint = CsvAppender('kids_supplements.csv')
         
-        # Обрабатываем ключевые запросы
-        df = existing_df
+        # По умолчанию (keyword_limit=1) обрабатывается только первый ключ
+        keywords = keywords[:keyword_limit] if keyword_limit else keywords
         
+        pending_terms = []
         for keyword_idx, search_term in enumerate(keywords):
-            print(f"\n🎯 Обработка ключевого запроса {keyword_idx+1}/{len(keywords)}: '{search_term}'")
+            print(f"\n🎯 Ключевой запрос {keyword_idx+1}/{len(keywords)}: '{search_term}'")
             
-            if not existing_df.empty and processor.check_search_term_processed(existing_df, search_term):
+            if processor.check_search_term_processed(search_term):
                 print(f"⏭️  Поисковый запрос '{search_term}' уже обработан, пропускаем поиск")
             else:
-                products = processor.search_products_multiple_pages(search_term, args.max_pages)
+                pending_terms.append(search_term)
+        
+        report(10, f'Поиск товаров: 0/{len(pending_terms)} ключевых запросов')
+        
+        # Поиски по разным ключам идут параллельно (не больше search_concurrency),
+        # результаты забираются по порядку ключей - нумерация строк не зависит от гонок
+        with ThreadPoolExecutor(max_workers=max(1, search_concurrency)) as search_pool:
+            searches = bounded_map(
+                search_pool,
+                lambda search_term: (search_term, processor.search_keyword(search_term, max_pages)),
+                pending_terms, max(1, search_concurrency)
+            )
+            
+            for done, (search_term, products) in enumerate(searches, 1):
+                report(10 + 30 * done // len(pending_terms),
+                       f'Поиск товаров: {done}/{len(pending_terms)} ключевых запросов')
                 
                 if not products:
                     print(f"❌ Товары не найдены для '{search_term}'")
                     continue
                 
-                df = processor.create_products_dataframe(products, search_term, df)
-                processor.save_results(df, 'kids_supplements.csv')
-                print(f"💾 Промежуточное сохранение: {len(df)} записей")
-            
-            # Тестируем только первый ключ
-            if keyword_idx >= 0:
-                break
+                start_index = len(existing_df) + new_rows + 1
+                new_frames.append(processor.build_product_records(products, search_term, start_index))
+                new_rows += len(new_frames[-1])
+                
+                checkpoint.append(new_frames[-1])
+                print(f"💾 Промежуточное сохранение: {len(existing_df) + new_rows} записей")
+        
+        df = processor.merge_records(existing_df, new_frames)
         
         if df.empty:
             print("❌ Нет данных для обработки")
-            return
+            return False
         
         # Обрабатываем детальные данные
-        df = processor.process_detailed_products(df, args.detail_limit)
+        report(40, 'Детальная обработка товаров...')
+        df = processor.process_detailed_products(
+            df, detail_limit,
+            progress_cb=lambda done, total: report(40 + 50 * done // total,
+                                                   f'Детальная обработка: {done}/{total} товаров')
+        )
         
         # Сохраняем результаты
-        processor.save_results(df, args.output_file)
+        report(95, 'Сохранение результатов...')
+        processor.save_results(df, output_file)
         processor.save_results(df, 'kids_supplements.csv')
         
         print(f"\n🎉 PIPELINE ЗАВЕРШЕН УСПЕШНО!")
-        print(f"📁 Результаты сохранены в: {args.output_file}")
-        
+        print(f"📁 Результаты сохранены в: {output_file}")
+        report(100, 'Обработка завершена успешно!')
+        return True
+    
+    finally:
+        processor.print_stats()
+        processor.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Полный pipeline с OpenAI Vision API')
+    parser.add_argument('--rainforest-key', help='Rainforest API ключ (или используется RAINFOREST_API_KEY из env)')
+    parser.add_argument('--openai-key', help='OpenAI API ключ (или используется OPENAI_API_KEY из env)')
+    parser.add_argument('--keywords-file', default='Kids Supplements Keywords.csv', help='Файл с ключевыми запросами')
+    parser.add_argument('--output-file', default='kids_supplements.csv', help='Выходной файл')
+    parser.add_argument('--max-pages', type=int, default=2, help='Максимум страниц поиска')
+    parser.add_argument('--keyword-limit', type=int, default=1,
+                        help='Сколько ключевых запросов обработать (0 - все)')
+    parser.add_argument('--search-concurrency', type=int, default=4,
+                        help='Параллельных поисков Rainforest по разным ключам')
+    parser.add_argument('--detail-limit', type=int, default=3, help='Количество товаров для детальной обработки')
+    parser.add_argument('--rainforest-concurrency', '--concurrency', type=int, default=4,
+                        help='Параллельных запросов детальных данных Rainforest')
+    parser.add_argument('--openai-concurrency', type=int, default=8,
+                        help='Параллельных запросов OpenAI Vision (realtime режим)')
+    parser.add_argument('--mode', choices=['realtime', 'batch'], default='realtime',
+                        help='Режим OpenAI Vision: realtime - сразу, batch - через Batch API (дешевле, до 24ч)')
+    parser.add_argument('--ocr-workers', type=int, default=1,
+                        help='Потоков OCR стадии (товаров одновременно). С одним Reader распознавание '
+                             'идет по очереди, параллельны только скачивание и подготовка кадров')
+    parser.add_argument('--easyocr-workers', type=int, default=1,
+                        help='Процессов easyocr со своим Reader (на GPU 24GB - 2-4; память растет с числом '
+                             'процессов). Потоков OCR стадии будет не меньше: --ocr-workers поднимается до этого числа')
+    parser.add_argument('--cache-dir', default='.supplement_cache',
+                        help='Папка кэша OCR и OpenAI результатов (пустая строка - без кэша на диске)')
+    
+    args = parser.parse_args()
+    
+    # Получаем API ключи из аргументов или environment variables
+    rainforest_key = args.rainforest_key or os.environ.get('RAINFOREST_API_KEY')
+    openai_key = args.openai_key or os.environ.get('OPENAI_API_KEY')
+    
+    if not rainforest_key:
+        print("❌ Ошибка: Rainforest API ключ не найден")
+        print("💡 Укажите --rainforest-key или установите RAINFOREST_API_KEY")
+        return
+    
+    if not openai_key:
+        print("❌ Ошибка: OpenAI API ключ не найден")
+        print("💡 Укажите --openai-key или установите OPENAI_API_KEY")
+        return
+    
+    try:
+        main_as_lib(
+            rainforest_key, openai_key,
+            keyword_limit=args.keyword_limit,
+            detail_limit=args.detail_limit,
+            keywords_file=args.keywords_file,
+            output_file=args.output_file,
+            max_pages=args.max_pages,
+            search_concurrency=args.search_concurrency,
+            rainforest_concurrency=args.rainforest_concurrency,
+            openai_concurrency=args.openai_concurrency,
+            mode=args.mode,
+            ocr_workers=args.ocr_workers,
+            easyocr_workers=args.easyocr_workers,
+            cache_dir=args.cache_dir
+        )
     except KeyboardInterrupt:
         print("\n⏹️ Обработка прервана пользователем")
     except Exception as e:
         print(f"\n❌ Критическая ошибка: {e}")
-    finally:
-        processor.print_stats()
 
 if __name__ == "__main__":
     main()
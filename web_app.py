@@ -5,14 +5,15 @@ Web интерфейс для Kids Supplements Pipeline на Render.com
 
 import os
 import threading
-import time
 from datetime import datetime
-from flask import Flask, render_template_string, request, send_file, jsonify
-import subprocess
+from flask import Flask, request, send_file, jsonify, Response
+import hashlib
 import json
 from pathlib import Path
 
 app = Flask(__name__)
+# За nginx/Apache файл отдает прокси через X-Sendfile (включается переменной окружения)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # Глобальные переменные для отслеживания состояния
 pipeline_status = {
@@ -23,6 +24,36 @@ pipeline_status = {
     'results_file': None
 }
 
+# Статус меняется редко, а опрашивается каждые 2 секунды из каждой вкладки:
+# JSON сериализуется один раз на изменение (версию), а не на каждый запрос
+status_lock = threading.Lock()
+# Подписчики /api/events ждут на условии и просыпаются только при изменении статуса
+status_changed = threading.Condition(status_lock)
+status_version = 0
+status_json_cache = (-1, '')
+
+# Запуск pipeline - один за раз: захватывается в api_start без ожидания, освобождается в run_pipeline.
+# Проверка pipeline_status['running'] не атомарна с запуском потока и пропускает двойной клик
+run_lock = threading.Lock()
+
+def update_status(**changes):
+    """Единственная точка изменения pipeline_status"""
+    global status_version
+    with status_changed:
+        pipeline_status.update(changes)
+        status_version += 1
+        status_changed.notify_all()
+
+def status_body():
+    """(версия, JSON статуса): сериализация один раз на версию"""
+    global status_json_cache
+    cached = status_json_cache
+    if cached[0] != status_version:
+        with status_lock:
+            cached = (status_version, json.dumps(pipeline_status))
+        status_json_cache = cached
+    return cached
+
 # HTML шаблон
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -49,25 +80,27 @@ HTML_TEMPLATE = '''
         .results { background: #e8f5e8; padding: 15px; border-radius: 5px; margin: 20px 0; }
     </style>
     <script>
+        function renderStatus(data) {
+            document.getElementById('status-message').textContent = data.message;
+            document.getElementById('progress-bar').style.width = data.progress + '%';
+            document.getElementById('progress-text').textContent = data.progress + '%';
+            
+            const statusDiv = document.getElementById('status');
+            statusDiv.className = 'status ' + (data.running ? 'running' : 'ready');
+            
+            document.getElementById('start-btn').disabled = data.running;
+            
+            if (data.results_file) {
+                document.getElementById('download-section').style.display = 'block';
+                document.getElementById('results-info').textContent = 
+                    'Последняя обработка: ' + (data.last_run || 'Неизвестно');
+            }
+        }
+        
         function updateStatus() {
             fetch('/api/status')
                 .then(response => response.json())
-                .then(data => {
-                    document.getElementById('status-message').textContent = data.message;
-                    document.getElementById('progress-bar').style.width = data.progress + '%';
-                    document.getElementById('progress-text').textContent = data.progress + '%';
-                    
-                    const statusDiv = document.getElementById('status');
-                    statusDiv.className = 'status ' + (data.running ? 'running' : 'ready');
-                    
-                    document.getElementById('start-btn').disabled = data.running;
-                    
-                    if (data.results_file) {
-                        document.getElementById('download-section').style.display = 'block';
-                        document.getElementById('results-info').textContent = 
-                            'Последняя обработка: ' + (data.last_run || 'Неизвестно');
-                    }
-                });
+                .then(renderStatus);
         }
         
         function startPipeline() {
@@ -92,7 +125,12 @@ HTML_TEMPLATE = '''
             });
         }
         
-        setInterval(updateStatus, 2000);
+        // Сервер присылает статус только при изменении (SSE); без EventSource - опрос раз в 2 секунды
+        if (window.EventSource) {
+            new EventSource('/api/events').onmessage = event => renderStatus(JSON.parse(event.data));
+        } else {
+            setInterval(updateStatus, 2000);
+        }
         window.onload = updateStatus;
     </script>
 </head>
@@ -139,29 +177,65 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# В шаблоне нет переменных: страница кодируется один раз при загрузке модуля,
+# повторные запросы браузера с If-None-Match получают 304
+INDEX_HTML = HTML_TEMPLATE.encode('utf-8')
+INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    response = Response(INDEX_HTML, mimetype='text/html')
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    response.set_etag(INDEX_ETAG)
+    return response.make_conditional(request)
 
 @app.route('/api/status')
 def api_status():
-    return jsonify(pipeline_status)
+    return Response(status_body()[1], mimetype='application/json')
+
+@app.route('/api/events')
+def api_events():
+    """Server-Sent Events: новый статус при каждом изменении, комментарий-пинг раз в 15 секунд"""
+    def stream():
+        version = -1
+        while True:
+            with status_changed:
+                changed = status_changed.wait_for(lambda: status_version != version, timeout=15)
+            if changed:
+                version, body = status_body()
+                yield f'data: {body}\n\n'
+            else:
+                yield ': ping\n\n'
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/start', methods=['POST'])
 def api_start():
-    global pipeline_status
-    
-    if pipeline_status['running']:
+    if not run_lock.acquire(blocking=False):
         return jsonify({'success': False, 'error': 'Pipeline уже запущен'})
     
-    data = request.get_json()
-    keyword_limit = data.get('keyword_limit', 5)
-    detail_limit = data.get('detail_limit', 10)
-    
-    # Запускаем pipeline в отдельном потоке
-    thread = threading.Thread(target=run_pipeline, args=(keyword_limit, detail_limit))
-    thread.daemon = True
-    thread.start()
+    try:
+        # Пустое поле формы приходит как null (parseInt('') = NaN): без проверки pipeline
+        # прошел бы все ключи и все товары
+        data = request.get_json(silent=True) or {}
+        try:
+            keyword_limit = int(data.get('keyword_limit', 5))
+            detail_limit = int(data.get('detail_limit', 10))
+        except (TypeError, ValueError):
+            keyword_limit = detail_limit = 0
+        
+        if keyword_limit < 1 or detail_limit < 1:
+            run_lock.release()
+            return jsonify({'success': False, 'error': 'Лимиты должны быть целыми числами не меньше 1'})
+        
+        # Запускаем pipeline в отдельном потоке (он и освобождает run_lock)
+        thread = threading.Thread(target=run_pipeline, args=(keyword_limit, detail_limit))
+        thread.daemon = True
+        thread.start()
+    except Exception:
+        run_lock.release()
+        raise
     
     return jsonify({'success': True})
 
@@ -169,27 +243,37 @@ def api_start():
 def download():
     results_file = Path('kids_supplements.csv')
     if results_file.exists():
-        return send_file(str(results_file), as_attachment=True, 
-                        download_name=f'kids_supplements_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv')
+        # ETag/Last-Modified по файлу: повторное скачивание без изменений получает 304,
+        # max_age=0 - браузер всегда сверяется с сервером после нового запуска
+        return send_file(str(results_file.resolve()), as_attachment=True,
+                        download_name=f'kids_supplements_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
+                        conditional=True, etag=True,
+                        last_modified=results_file.stat().st_mtime, max_age=0)
     else:
         return "Файл результатов не найден", 404
 
+# (mtime_ns, данные) последнего прочитанного pipeline_stats.json: файл перечитывается,
+# только когда run_pipeline его заменил
+stats_cache = (None, None)
+
 @app.route('/api/stats')
 def api_stats():
+    global stats_cache
     stats_file = Path('pipeline_stats.json')
-    if stats_file.exists():
+    try:
+        mtime = stats_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        return jsonify({'error': 'Статистика не найдена'})
+    
+    cached_mtime, stats = stats_cache
+    if cached_mtime != mtime:
         with open(stats_file, 'r') as f:
             stats = json.load(f)
-        return jsonify(stats)
-    else:
-        return jsonify({'error': 'Статистика не найдена'})
+        stats_cache = (mtime, stats)
+    return jsonify(stats)
 
 def run_pipeline(keyword_limit, detail_limit):
-    global pipeline_status
-    
-    pipeline_status['running'] = True
-    pipeline_status['progress'] = 0
-    pipeline_status['message'] = 'Инициализация...'
+    update_status(running=True, progress=0, message='Инициализация...')
     
     try:
         # Получаем API ключи из переменных окружения
@@ -197,42 +281,30 @@ def run_pipeline(keyword_limit, detail_limit):
         openai_key = os.getenv('OPENAI_API_KEY')
         
         if not rainforest_key or not openai_key:
-            pipeline_status['message'] = 'Ошибка: API ключи не настроены'
-            pipeline_status['running'] = False
+            update_status(message='Ошибка: API ключи не настроены', running=False)
             return
         
-        pipeline_status['progress'] = 10
-        pipeline_status['message'] = 'Запуск pipeline...'
-        
-        # Формируем команду (API ключи передаются через environment variables)
-        cmd = [
-            'python3', 'pipeline_openai_complete.py',
-            '--keywords-file', 'Kids Supplements Keywords.csv',
-            '--output-file', output_file,
-            '--max-pages', '2',
-            '--detail-limit', str(detail_limit)
-        ]
-        
-        pipeline_status['progress'] = 20
-        pipeline_status['message'] = 'Обработка данных...'
-        
-        # Запускаем pipeline с передачей environment variables
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=os.environ)
+        update_status(progress=2, message='Загрузка pipeline...')
         
-        # Симуляция прогресса (в реальности можно парсить вывод pipeline)
-        for i in range(20, 90, 10):
-            if process.poll() is None:  # Процесс еще работает
-                pipeline_status['progress'] = i
-                time.sleep(30)  # Обновляем каждые 30 секунд
+        # Модуль pipeline тянет torch/easyocr: импортируем при первом запуске, а не при старте сервера.
+        # Pipeline работает в этом же потоке - без нового интерпретатора и повторной загрузки моделей,
+        # прогресс приходит из стадий, а не по таймеру
+        from pipeline_openai_complete import main_as_lib
         
-        # Ждем завершения
-        stdout, stderr = process.communicate()
+        success = main_as_lib(
+            rainforest_key, openai_key, keyword_limit, detail_limit,
+            progress_cb=lambda pct, msg: update_status(progress=pct, message=msg),
+            keywords_file='Kids Supplements Keywords.csv',
+            max_pages=2
+        )
         
-        if process.returncode == 0:
-            pipeline_status['progress'] = 100
-            pipeline_status['message'] = 'Обработка завершена успешно!'
-            pipeline_status['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            pipeline_status['results_file'] = 'kids_supplements.csv'
+        if success:
+            update_status(
+                progress=100,
+                message='Обработка завершена успешно!',
+                last_run=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                results_file='kids_supplements.csv'
+            )
             
             # Сохраняем статистику
             stats = {
@@ -241,16 +313,18 @@ def run_pipeline(keyword_limit, detail_limit):
                 'detail_limit': detail_limit,
                 'success': True
             }
-            with open('pipeline_stats.json', 'w') as f:
+            with open('pipeline_stats.json.tmp', 'w') as f:
                 json.dump(stats, f)
+            os.replace('pipeline_stats.json.tmp', 'pipeline_stats.json')
         else:
-            pipeline_status['message'] = f'Ошибка выполнения: {stderr[:200]}'
+            update_status(message='Ошибка выполнения: нет данных для обработки')
             
     except Exception as e:
-        pipeline_status['message'] = f'Критическая ошибка: {str(e)[:200]}'
+        update_status(message=f'Критическая ошибка: {str(e)[:200]}')
     
     finally:
-        pipeline_status['running'] = False
+        update_status(running=False)
+        run_lock.release()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))